@@ -9,6 +9,9 @@ import os, argparse, ctypes
 import parsing
 import core
 import inference
+import inference_cache
+import inference_stats
+import traits
 import prelude
 import lower
 import utils
@@ -109,6 +112,9 @@ class JIT:
 if __name__ == "__main__":
 	p = argparse.ArgumentParser()
 	p.add_argument("source")
+	p.add_argument("--jobs", type=int, default=None, help="Infer independent top-level components in a pool of this many processes.")
+	p.add_argument("--cache", default=None, help="Reuse inferred types of unchanged top-level components from this file, and update it.")
+	p.add_argument("--stats", default=None, help="Write statistics about inference to this file, as JSON.")
 	args = p.parse_args()
 
 	with open(args.source) as f:
@@ -124,8 +130,16 @@ if __name__ == "__main__":
 
 	# Do inference.
 	gamma = prelude.make_gamma()
-	inf = inference.Inference()
+	cache = inference_cache.InferenceCache(args.cache) if args.cache is not None else None
+	stats = inference_stats.InferenceStats() if args.stats is not None else None
+	inf = inference.Inference(jobs=args.jobs, cache=cache, traits=traits.TraitResolver(lowerer.top_level.impls), stats=stats)
+	inf.infer_impls(gamma)
 	inf.infer_code_block(gamma, lowerer.top_level.root_block)
+	if cache is not None:
+		cache.save()
+		print "Inference cache: %i hits, %i misses" % (cache.hits, cache.misses)
+	if stats is not None:
+		stats.save(args.stats)
 
 	print "=" * 20, "Post-inference:"
 
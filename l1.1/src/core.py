@@ -348,6 +348,8 @@ class MethodCallExpr(Expr):
 		self.fn_expr = fn_expr
 		self.method_name = method_name
 		self.arg_exprs = arg_exprs
+		# The impl the call was statically resolved to by inference, if any.
+		self.impl = None
 
 	def key(self):
 		return self.fn_expr, self.method_name, tuple(self.arg_exprs)
@@ -502,15 +504,19 @@ class AppType(MonoType):
 		)
 
 class VarType(MonoType):
-	def __init__(self, name):
-		assert isinstance(name, str)
-		self.name = name
+	def __init__(self, id):
+		"""VarType(id)
+
+		Type variables are identified by dense integer ids, which index directly into inference.UnificationContext's arrays.
+		"""
+		assert isinstance(id, int)
+		self.id = id
 
 	def key(self):
-		return self.name
+		return self.id
 
 	def pretty(self, b):
-		b.write("?%s" % (self.name,))
+		b.write("?%i" % (self.id,))
 
 	def free_type_variables(self):
 		return set([self])
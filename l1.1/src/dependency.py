@@ -3,8 +3,13 @@
 import collections
 
 class DependencyManager:
-	def __init__(self):
+	def __init__(self, debug=False):
+		"""DependencyManager(debug=False)
+
+		If debug is set then every order we compute is checked against every dependency.
+		"""
 		self.dependencies = collections.defaultdict(set)
+		self.debug = debug
 
 	def add_dep(self, a, b):
 		"""add_dep(a, b) -> make a dependend on b"""
@@ -12,62 +17,127 @@ class DependencyManager:
 		self.dependencies[b]
 
 	def strongly_connected_components(self):
+		components, levels = self.strongly_connected_components_with_levels()
+		return components
+
+	def strongly_connected_components_with_levels(self):
+		"""strongly_connected_components_with_levels() -> ([component], [level of each component])
+
+		Components come dependencies first, and each is a list of nodes.
+		A component's level is one more than the highest level of any component it depends on, so components of the same level never depend on each other.
+
+		This is Tarjan's algorithm, with an explicit stack of (node, iterator over its unvisited deps) in place of recursion, so that long chains of dependencies can't exceed Python's recursion limit.
+		"""
+		dependencies = self.dependencies
 		index = {}
 		low_link = {}
-		on_stack = collections.defaultdict(bool)
-		next_index = [0]
-		scc = []
+		on_stack = set()
 		stack = []
 		components = []
+		levels = []
+		component_of = {}
 
-		def strong_connect(node):
-			index[node] = low_link[node] = next_index[0]
-			next_index[0] += 1
-			stack.append(node)
-			on_stack[node] = True
-
-			for dep in self.dependencies[node]:
-				if dep not in index:
-					strong_connect(dep)
-					low_link[node] = min(low_link[node], low_link[dep])
-				elif on_stack[dep]:
-					# index[] rather than low_link[] in the next line is intentional.
-					low_link[node] = min(low_link[node], index[dep])
-
-			if low_link[node] == index[node]:
-				scc[:] = []
-				while True:
-					w = stack.pop()
-					on_stack[w] = False
-					scc.append(w)
-					if w == node:
+		for root in dependencies:
+			if root in index:
+				continue
+			index[root] = low_link[root] = len(index)
+			stack.append(root)
+			on_stack.add(root)
+			work = [(root, iter(dependencies[root]))]
+			while work:
+				node, deps = work[-1]
+				for dep in deps:
+					if dep not in index:
+						# Visit dep, and come back to the rest of node's deps once it's done.
+						index[dep] = low_link[dep] = len(index)
+						stack.append(dep)
+						on_stack.add(dep)
+						work.append((dep, iter(dependencies[dep])))
 						break
-				components.append(scc[:])
+					elif dep in on_stack:
+						# index[] rather than low_link[] in the next line is intentional.
+						low_link[node] = min(low_link[node], index[dep])
+				else:
+					work.pop()
+					if work:
+						parent = work[-1][0]
+						low_link[parent] = min(low_link[parent], low_link[node])
+					if low_link[node] != index[node]:
+						continue
+					component = []
+					while True:
+						w = stack.pop()
+						on_stack.remove(w)
+						component.append(w)
+						if w == node:
+							break
+					# Every component this one depends on has already been completed, so its level is known.
+					i = len(components)
+					for w in component:
+						component_of[w] = i
+					level = 0
+					for w in component:
+						for dep in dependencies[w]:
+							if component_of[dep] != i:
+								level = max(level, levels[component_of[dep]] + 1)
+					components.append(component)
+					levels.append(level)
 
-		for node in self.dependencies:
-			if node not in index:
-				strong_connect(node)
-		self.sanity_check(components)
-		return components
+		if self.debug:
+			self.sanity_check(components, levels)
+		return components, levels
 
-	def sanity_check(self, components):
+	def sanity_check(self, components, levels):
 		# Compute the time at which each node is defined.
 		times = {}
 		for i, component in enumerate(components):
 			for node in component:
 				times[node] = i
-		# Demand that each node is defined no earlier than all its deps.
+		# Demand that each node is defined no earlier than all its deps, and at a higher level unless they're in the same component.
 		for node, deps in self.dependencies.iteritems():
 			for dep in deps:
 				assert times[dep] <= times[node]
+				assert times[dep] == times[node] or levels[times[dep]] < levels[times[node]]
 
 if __name__ == "__main__":
-	g = DependencyManager()
+	import sys, time, random
+	g = DependencyManager(debug=True)
 	g.add_dep("a", "b")
 	g.add_dep("b", "c")
 	g.add_dep("d", "a")
 	g.add_dep("c", "b")
-	components = g.strongly_connected_components()
-	for comp in components:
-		print comp
+	components, levels = g.strongly_connected_components_with_levels()
+	for comp, level in zip(components, levels):
+		print level, comp
+
+	# Benchmark on large graphs: a chain (far deeper than the recursion limit), a single cycle, and random sparse graphs.
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	def chain(g):
+		for i in xrange(n - 1):
+			g.add_dep(i + 1, i)
+	def cycle(g):
+		chain(g)
+		g.add_dep(0, n - 1)
+	def random_graph(edges_per_node):
+		def build(g):
+			r = random.Random(0)
+			for i in xrange(n):
+				for _ in xrange(edges_per_node):
+					g.add_dep(i, r.randrange(n))
+		return build
+	for name, build in [("chain", chain), ("cycle", cycle), ("random, 1 edge/node", random_graph(1)), ("random, 3 edges/node", random_graph(3))]:
+		for debug in (False, True):
+			g = DependencyManager(debug=debug)
+			build(g)
+			start = time.time()
+			components, levels = g.strongly_connected_components_with_levels()
+			print "%-22s debug=%-5s %i nodes: %i components, %i levels, largest %i, in %.3fs" % (
+				name + ":",
+				debug,
+				len(g.dependencies),
+				len(components),
+				max(levels) + 1,
+				max(len(component) for component in components),
+				time.time() - start,
+			)
 
@@ -1,6 +1,9 @@
 #!/usr/bin/python
 
 import sys
+import time
+import array
+import multiprocessing
 import dependency
 import core
 import utils
@@ -11,8 +14,7 @@ def alpha_canonicalize(t, subs=None):
 		subs = {}
 	if isinstance(t, core.VarType):
 		if t not in subs:
-			new_name = str(len(subs) + 1)
-			subs[t] = core.VarType(new_name)
+			subs[t] = core.VarType(len(subs) + 1)
 		return subs[t]
 	elif isinstance(t, core.AppType):
 		return core.AppType(
@@ -27,67 +29,298 @@ def alpha_canonicalize(t, subs=None):
 def alpha_equivalent(t1, t2):
 	return alpha_canonicalize(t1) == alpha_canonicalize(t2)
 
+def freshen(t, subs):
+	"""freshen(t, subs) -> t (a MonoType or PolyType) with every type variable renamed to a fresh one, consistently with subs, which is extended"""
+	if isinstance(t, core.PolyType):
+		return core.PolyType(set(freshen(v, subs) for v in t.binders), freshen(t.mono, subs))
+	elif isinstance(t, core.VarType):
+		if t not in subs:
+			subs[t] = global_new_type()
+		return subs[t]
+	elif isinstance(t, core.AppType):
+		return core.AppType(t.constructor, [freshen(arg, subs) for arg in t.args])
+	return t
+
+def annotated_nodes(entries):
+	"""annotated_nodes(entries) -> every Declaration, nested CodeBlock and MethodCallExpr in or under the given code block entries, in a fixed order
+
+	These are the nodes that inference annotates with its results.
+	"""
+	stack = list(reversed(entries))
+	while stack:
+		node = stack.pop()
+		if isinstance(node, (core.Declaration, core.CodeBlock, core.MethodCallExpr)):
+			yield node
+		if isinstance(node, core.CodeBlock):
+			children = node.entries
+		elif isinstance(node, (core.Declaration, core.Reassignment, core.TypeConstraint, core.ExprEvaluation, core.ReturnStatement)):
+			children = [node.expr]
+		elif isinstance(node, (core.LoopStatement, core.BlockExpr)):
+			children = [node.code_block]
+		elif isinstance(node, (core.AppExpr, core.MethodCallExpr)):
+			children = [node.fn_expr] + node.arg_exprs
+		elif isinstance(node, core.AbsExpr):
+			children = [node.result_expr]
+		elif isinstance(node, core.LetExpr):
+			children = [node.expr1, node.expr2]
+		elif isinstance(node, core.IfExpr):
+			children = [node.cond_expr, node.true_expr, node.false_expr]
+		else:
+			children = []
+		stack.extend(reversed(children))
+
 class UnificationError(Exception):
 	pass
 
 class UnificationContext:
+	"""UnificationContext
+
+	A union-find over type variable ids, stored in arrays indexed by id.
+	Each union set's root may additionally have a link: the AppType that every variable in the set is known to equal.
+	AppTypes themselves never enter the union-find; equating two of them just equates their arguments.
+
+	Each root also has a level: the let-depth at which its oldest variable was created (see Inference.generalize).
+	We maintain that every variable reachable through a root's link has a level no greater than the root's.
+
+	We don't do an occurs check when binding: equate() unions before it recurses, so it terminates even on cyclic links.
+	Instead most_specific_type() reports any cycle it finds as an infinite type, which costs nothing beyond the traversal it does anyway.
+	A cycle needn't be reachable from any type we generalize (e.g. it may be in the type of an argument), so every root given a link is also remembered, and check_occurs() resolves them all before generalizing.
+
+	Unification is destructive, but while any snapshot is open every write is recorded on a trail, so that rollback() can undo just the writes made since its snapshot.
+	"""
 	def __init__(self):
-		self.unions = utils.UnionFind()
-		self.union_set_links = {}
+		self.parents = array.array("l")
+		self.ranks = array.array("B")
+		self.levels = array.array("l")
+		# links[root] is the AppType the root's union set is equal to, or None.
+		self.links = []
+		# A list of (container, index, old value), or None if no snapshot is open.
+		self.trail = None
+		self.open_snapshots = 0
+		# Bumped whenever a union set or link changes, invalidating every entry of self.resolved.
+		self.version = 0
+		# resolved[root] is (version, most specific type of root) as of that version.
+		self.resolved = {}
+		# The roots given links since the last check_occurs().
+		self.unchecked = []
 
 	def copy(self):
 		u = UnificationContext()
-		u.unions = self.unions.copy()
-		u.union_set_links = self.union_set_links.copy()
+		u.parents = array.array("l", self.parents)
+		u.ranks = array.array("B", self.ranks)
+		u.levels = array.array("l", self.levels)
+		u.links = self.links[:]
+		u.unchecked = self.unchecked[:]
 		return u
 
+	def snapshot(self):
+		"""snapshot() -> a snapshot, which must later be passed to exactly one of rollback() or commit()"""
+		if self.trail is None:
+			self.trail = []
+		self.open_snapshots += 1
+		return len(self.trail)
+
+	def rollback(self, snapshot):
+		"""rollback(snapshot) -> None
+
+		Undo every write made since snapshot was taken, in time linear in their number.
+		"""
+		trail = self.trail
+		while len(trail) > snapshot:
+			container, index, value = trail.pop()
+			container[index] = value
+		self.version += 1
+		self.commit(snapshot)
+
+	def commit(self, snapshot):
+		"""commit(snapshot) -> None
+
+		Keep every write made since snapshot was taken.
+		"""
+		assert self.open_snapshots > 0
+		self.open_snapshots -= 1
+		if self.open_snapshots == 0:
+			self.trail = None
+
+	def try_equate(self, t1, t2):
+		"""try_equate(t1, t2) -> True if t1 and t2 were unified, otherwise False, leaving the context unchanged"""
+		snapshot = self.snapshot()
+		try:
+			self.equate(t1, t2)
+		except UnificationError:
+			self.rollback(snapshot)
+			return False
+		self.commit(snapshot)
+		return True
+
+	def assign(self, container, index, value):
+		if self.trail is not None:
+			self.trail.append((container, index, container[index]))
+		container[index] = value
+
+	def grow(self, id):
+		# Type variable ids are handed out globally, so we lazily make room for any we haven't seen yet as singletons.
+		size = len(self.parents)
+		if id >= size:
+			self.parents.extend(xrange(size, id + 1))
+			self.ranks.extend([0] * (id + 1 - size))
+			self.levels.extend([0] * (id + 1 - size))
+			self.links.extend([None] * (id + 1 - size))
+
+	def find(self, id):
+		"""find(id) -> the id of the root of id's union set"""
+		parents = self.parents
+		if id >= len(parents):
+			self.grow(id)
+			return id
+		root = id
+		while parents[root] != root:
+			root = parents[root]
+		# Compress the path, unless we'd have to trail it.
+		if self.trail is None:
+			while parents[id] != root:
+				parents[id], id = root, parents[id]
+		return root
+
+	def set_level(self, id, level):
+		self.grow(id)
+		self.assign(self.levels, id, level)
+
+	def lower_level(self, t, level):
+		"""lower_level(t, level) -> None
+
+		Lower the level of every variable in t (following links) to at most level.
+		By our invariant we needn't look under any variable whose level is already low enough.
+		"""
+		levels, links = self.levels, self.links
+		stack = [t]
+		while stack:
+			t = stack.pop()
+			if isinstance(t, core.VarType):
+				root = self.find(t.id)
+				if levels[root] <= level:
+					continue
+				self.assign(levels, root, level)
+				t = links[root]
+				if t is None:
+					continue
+			stack.extend(t.args)
+
+	def union(self, r1, r2):
+		"""union(r1, r2) -> the new root, after merging the union sets rooted at r1 and r2"""
+		if self.ranks[r1] < self.ranks[r2]:
+			r1, r2 = r2, r1
+		elif self.ranks[r1] == self.ranks[r2]:
+			self.assign(self.ranks, r1, self.ranks[r1] + 1)
+		self.assign(self.parents, r2, r1)
+		return r1
+
 	def equate(self, t1, t2):
 		"""equate(t1, t2) -> None
 
 		Add the constraint that the t1 and t2 type expressions must be equal.
-		Critically, if either t1 or t2's current union sets contains a link then we recursively union the respective links.
+		Critically, if both t1 and t2's current union sets contain a link then we recursively unify the respective links.
 		"""
 		assert isinstance(t1, core.MonoType)
 		assert isinstance(t2, core.MonoType)
 #		print "Equating:", t1, t2
-		# TODO: Add occurs check!
-
-		# Canonicalize our types into existing union sets.
-		t1, t2 = self.unions[t1], self.unions[t2]
-		# Union together the two types, links or not.
-		self.unions.union(t1, t2)
-		# If a term is a link then it becomes a union set link.
-		for t in (t1, t2):
-			if isinstance(t, core.AppType):
-				self.union_set_links[t] = t
-		# If both t1 and t2 have existing union set links then recursively unify them.
-		if t1 in self.union_set_links and t2 in self.union_set_links:
-			l1, l2 = self.union_set_links[t1], self.union_set_links[t2]
+		# The occurs check is deferred to most_specific_type.
+
+		# Canonicalize variables into their existing union sets, and find their links.
+		if isinstance(t1, core.VarType):
+			r1 = self.find(t1.id)
+			l1 = self.links[r1]
+		else:
+			r1, l1 = None, t1
+		if isinstance(t2, core.VarType):
+			r2 = self.find(t2.id)
+			l2 = self.links[r2]
+		else:
+			r2, l2 = None, t2
+		if r1 is not None and r1 == r2:
+			return
+		# Union together the two union sets, or record a link as the set's link.
+		# Either way, if at least one of the two has a link then it becomes the link for them both.
+		# We don't have to worry about which one we picked because we then recursively equate the two.
+		if r1 is not None or r2 is not None:
+			self.version += 1
+		if r1 is not None and r2 is not None:
+			level = min(self.levels[r1], self.levels[r2])
+			root = self.union(r1, r2)
+			link = l1 if l1 is not None else l2
+			self.assign(self.links, root, link)
+			self.assign(self.levels, root, level)
+			if link is not None:
+				self.unchecked.append(root)
+				self.lower_level(link, level)
+		elif r1 is not None:
+			if l1 is None:
+				self.assign(self.links, r1, l2)
+				self.unchecked.append(r1)
+				self.lower_level(l2, self.levels[r1])
+		elif r2 is not None:
+			if l2 is None:
+				self.assign(self.links, r2, l1)
+				self.unchecked.append(r2)
+				self.lower_level(l1, self.levels[r2])
+		# If both t1 and t2 have links then recursively unify them.
+		if l1 is not None and l2 is not None and l1 is not l2:
 			assert isinstance(l1, core.AppType) and isinstance(l2, core.AppType)
 			if len(l1.args) != len(l2.args) or l1.constructor != l2.constructor:
 				raise UnificationError("Cannot unify %r with %r" % (l1, l2))
 			for a, b in zip(l1.args, l2.args):
 				self.equate(a, b)
-		# If at least one of the two has a union set link then store it as the new union set link for them both.
-		# We don't have to worry about which one we picked because we just recursively equated the two.
-		for t in (t1, t2):
-			if t in self.union_set_links:
-				self.union_set_links[self.unions[t1]] = self.union_set_links[t]
+
+	def level(self, t):
+		assert isinstance(t, core.VarType)
+		return self.levels[self.find(t.id)]
 
 	def must_equal(self, t1, t2):
-		return self.unions[t1] == self.unions[t2]
+		if isinstance(t1, core.VarType) and isinstance(t2, core.VarType):
+			return self.find(t1.id) == self.find(t2.id)
+		return self.most_specific_type(t1) == self.most_specific_type(t2)
+
+	def check_occurs(self):
+		"""check_occurs() -> None
 
-	def most_specific_type(self, t):
-		t = self.unions[t]
-		# If the union set contains a link, then we consider that more specific than a variable, so use that instead.
-		if t in self.union_set_links:
-			t = self.union_set_links[t]
+		Raises UnificationError if any root given a link since the last call now has an infinite type.
+		Every root is resolved at most once, as most_specific_type caches them until the next change.
+		"""
+		unchecked, self.unchecked = self.unchecked, []
+		for root in unchecked:
+			self.most_specific_type(core.VarType(root))
+
+	def most_specific_type(self, t, visiting=None):
+		"""most_specific_type(t) -> t with every variable replaced by its union set's link, recursively
+
+		Raises UnificationError if t is an infinite type, i.e. some variable occurs in its own link.
+		Results are cached per root until the next change to the unification context, and any subtree that's already most specific is returned as is, rather than rebuilt.
+		"""
+		if isinstance(t, core.VarType):
+			root = self.find(t.id)
+			# If the union set contains a link, then we consider that more specific than a variable, so use that instead.
+			link = self.links[root]
+			if link is None:
+				return t if root == t.id else core.VarType(root)
+			cached = self.resolved.get(root)
+			if cached is not None and cached[0] == self.version:
+				return cached[1]
+			# visiting holds the roots whose links we're currently inside of, so meeting one again means a cycle.
+			if visiting is None:
+				visiting = set()
+			elif root in visiting:
+				raise UnificationError("Infinite type: ?%i occurs in %r" % (root, link))
+			visiting.add(root)
+			result = self.most_specific_type(link, visiting)
+			visiting.remove(root)
+			self.resolved[root] = self.version, result
+			return result
 		# Recursively make the type specific.
 		if isinstance(t, core.AppType):
-			return core.AppType(
-				t.constructor,
-				[self.most_specific_type(x) for x in t.args],
-			)
+			args = [self.most_specific_type(x, visiting) for x in t.args]
+			if all(new is old for new, old in zip(args, t.args)):
+				return t
+			return core.AppType(t.constructor, args)
 		return t
 
 # TODO: XXX: I'm not sure I like this...
@@ -96,45 +329,91 @@ global_type_counter = 0
 def global_new_type():
 	global global_type_counter
 	global_type_counter += 1
-	return core.VarType(str(global_type_counter))
+	return core.VarType(global_type_counter)
 
 class Gamma(object):
 	"""Gamma
 
-	Defines a typing context.
+	Defines a typing context, as a chain of scopes.
+	Each scope holds only the names bound in it (by variable name), and defers every other lookup to its parent, so copy() is O(1) and lookups cost O(scope depth) rather than O(|Gamma|).
+	A scope must not be assigned to while copies of it are still in use, as they'd see the assignment.
 	"""
-	__slots__ = "context", "return_monotype"
+	__slots__ = "context", "parent", "return_monotype"
 
-	def __init__(self):
+	def __init__(self, parent=None):
 		self.context = {}
-		self.return_monotype = None
+		self.parent = parent
+		self.return_monotype = None if parent is None else parent.return_monotype
 
 	def __repr__(self):
-		return "%r (ret=%r)" % (self.context, self.return_monotype)
+		scopes = []
+		gamma = self
+		while gamma is not None:
+			scopes.append(gamma.context)
+			gamma = gamma.parent
+		return "%s (ret=%r)" % (" <- ".join(map(repr, scopes)), self.return_monotype)
 
 	def __getitem__(self, key):
-		return self.context[key]
+		name = key.name
+		gamma = self
+		while gamma is not None:
+			if name in gamma.context:
+				return gamma.context[name]
+			gamma = gamma.parent
+		raise KeyError(key)
 
 	def __setitem__(self, key, value):
 		assert isinstance(key, core.VarExpr)
 		assert isinstance(value, core.PolyType)
-		self.context[key] = value
+		self.context[key.name] = value
 
 	def __contains__(self, key):
 		assert isinstance(key, core.VarExpr)
-		return key in self.context
+		name = key.name
+		gamma = self
+		while gamma is not None:
+			if name in gamma.context:
+				return True
+			gamma = gamma.parent
+		return False
 
 	def copy(self):
-		"""copy() -> shallow copy of the context"""
-		new_gamma = Gamma()
-		new_gamma.context = self.context.copy()
-		new_gamma.return_monotype = self.return_monotype
-		return new_gamma
+		"""copy() -> a new empty scope on top of this one"""
+		return Gamma(self)
+
+def infer_component_in_worker(task):
+	"""infer_component_in_worker((component, context, traits)) -> the Inference.annotations of component
+
+	Runs in a worker process, with its own unification context and type variable ids, so only the annotations are sent back, for the parent to apply with fresh ids.
+	context maps the name of everything the component depends on to its (closed) PolyType.
+	"""
+	component, context, traits = task
+	gamma = Gamma()
+	for name, poly_t in context.iteritems():
+		gamma[core.VarExpr(name)] = poly_t
+	inf = Inference(traits=traits)
+	inf.infer_component(gamma, component)
+	return inf.annotations(component)
 
 class Inference:
-	def __init__(self):
-		self.unification_context = UnificationContext()
+	def __init__(self, jobs=None, cache=None, traits=None, stats=None):
+		"""Inference(jobs=None, cache=None, traits=None, stats=None)
+
+		If jobs is more than one then the independent components of top-level code blocks are inferred in a pool of that many processes.
+		If cache is an inference_cache.InferenceCache then top-level components are looked up in it before being inferred, and stored into it after.
+		If traits is a traits.TraitResolver then method calls are resolved with it, and typed by the resolved impl's method.
+		If stats is an inference_stats.InferenceStats then it collects statistics about this inference.
+		"""
+		self.jobs = jobs
+		self.cache = cache
+		self.traits = traits
+		self.stats = stats
+		self.unification_context = UnificationContext() if stats is None else stats.unification_context()
 		self.type_counter = 0
+		# The current let-depth, which every new type variable is created at.
+		self.level = 0
+		# Maps id(impl) to the impl's index in self.traits.impls, built on first use.
+		self.impl_indices = None
 
 	def inst(self, poly_t):
 		"""inst(poly_t: PolyType) -> a new MonoType
@@ -147,21 +426,24 @@ class Inference:
 
 	def new_type(self):
 		# TODO: XXX: For now...
-		return global_new_type()
+		t = global_new_type()
+		self.unification_context.set_level(t.id, self.level)
+		return t
 #		self.type_counter += 1
-#		return core.VarType("%i" % (self.type_counter,))
+#		return core.VarType(self.type_counter)
 
-	def contextual_generalization(self, gamma, t):
-		"""contextual_generalization(gamma, t: MonoType) -> PolyType
+	def generalize(self, t):
+		"""generalize(t: MonoType) -> PolyType
 
-		Returns the generalization of t (a MonoType) as a PolyType, with every free variable of t not elsewhere used in the context gamma universally quantified.
+		Returns the generalization of t (a most specific MonoType) as a PolyType, with every free variable of t created deeper than the current let-depth universally quantified.
+		Any variable that's also free in the context was either created at an outer let-depth, or has had its level lowered by being unified with one that was, so we never need to look at the context.
 		"""
 		assert isinstance(t, core.MonoType)
-		all_bound = set()
-		for poly_t in gamma.context.values():
-			all_bound |= poly_t.free_type_variables()
 		return core.PolyType(
-			t.free_type_variables() - all_bound,
+			set(
+				v for v in t.free_type_variables()
+				if self.unification_context.level(v) > self.level
+			),
 			t,
 		)
 
@@ -194,9 +476,22 @@ class Inference:
 			)
 			return result_type
 		elif isinstance(expr, core.MethodCallExpr):
-			# Darn, we have no idea at all!
-			# XXX: TODO: Make this not completely stupid, using trait resolution.
-			return self.new_type()
+			receiver_t = self.J(gamma, expr.fn_expr, depth=depth+1)
+			arg_types = [self.J(gamma, arg, depth=depth+1) for arg in expr.arg_exprs]
+			result_type = self.new_type()
+			if self.traits is None:
+				# Darn, we have no idea at all!
+				return result_type
+			# Resolve the call statically if we can, in which case the receiver is the method's first argument.
+			receiver_t = self.unification_context.most_specific_type(receiver_t)
+			expr.impl = self.traits.resolve(expr.method_name, receiver_t)
+			method_poly_t = None if expr.impl is None else self.traits.method_type(expr.impl, expr.method_name)
+			if method_poly_t is not None:
+				self.unification_context.equate(
+					self.inst(method_poly_t),
+					core.AppType("fun", [receiver_t] + arg_types + [result_type]),
+				)
+			return result_type
 		elif isinstance(expr, core.AbsExpr):
 			args = [core.VarExpr(arg_name) for arg_name in expr.arg_names]
 			# Do inference on the result expression, in a context where the argument has a fresh type.
@@ -210,11 +505,14 @@ class Inference:
 			return core.AppType("fun", arg_types + [result_type])
 		elif isinstance(expr, core.LetExpr):
 			var = core.VarExpr(expr.name)
-			# Do inference on the variable's expression.
+			# Do inference on the variable's expression, one let-depth deeper.
+			self.level += 1
 			var_t = self.J(gamma, expr.expr1, depth=depth+1)
+			self.level -= 1
+			self.unification_context.check_occurs()
 			var_t = self.unification_context.most_specific_type(var_t)
-			# Contextually generalize the variable's type.
-			var_poly_t = self.contextual_generalization(gamma, var_t)
+			# Generalize the variable's type.
+			var_poly_t = self.generalize(var_t)
 			# Do inference on the resultant expression, in a context where the variable has the given value.
 			gamma_prime = gamma.copy()
 			gamma_prime[var] = var_poly_t
@@ -235,11 +533,20 @@ class Inference:
 			#return core.AppType("nil", [])
 		raise NotImplementedError("Not handled: %r" % (expr,))
 
+	def infer_impls(self, gamma):
+		"""infer_impls(gamma) -> None
+
+		Infers the methods of every impl known to our trait resolver, so that the method calls resolved to them can be typed.
+		"""
+		for impl in self.traits.impls:
+			# Impl blocks aren't top-level blocks, so they're never farmed out to a pool or cached.
+			self.infer_code_block(gamma, impl.code_block, depth=1)
+
 	def infer_code_block(self, gamma, code_block, depth=0):
 		# Give the code block a new return type.
 		assert code_block.return_monotype == None
-		code_block.return_monotype = global_new_type()
-		gamma = gamma.copy()
+		code_block.return_monotype = self.new_type()
+		gamma = gamma.copy() if self.stats is None else self.stats.scope(gamma)
 		gamma.return_monotype = code_block.return_monotype
 
 		# Compute which names are provided by which declarations.
@@ -264,7 +571,7 @@ class Inference:
 					pass
 
 		# Compute an order to perform inference in.
-		strongly_connected_components = dep_manager.strongly_connected_components()
+		strongly_connected_components, levels = dep_manager.strongly_connected_components_with_levels()
 		print "\nStrongly connected components:", strongly_connected_components
 
 		# Throw in every decl that wasn't included in any dep, and therefore isn't in any strongly connected component.
@@ -274,56 +581,190 @@ class Inference:
 #		print "Remaining:", remaining_decls
 
 		# It really doesn't matter how we throw these remaining decls in, but for now we just add each one as its own component at the end.
+		# They depend on nothing, so they're all at the lowest level.
 		for decl in remaining_decls:
 			strongly_connected_components.append([decl])
+			levels.append(0)
 
 		print "Inference groups:", strongly_connected_components
-
-		# Compute typing for each strongly connected component together.
-		for component in strongly_connected_components:
-			name_types = {}
-			print "=== Inference for component:", component
-
-			# Add fresh monotype variables to our system for the names declared in this component.
-			for decl in component:
-				for name in decl.provided_names():
-					new_type_var = name_types[name] = self.new_type()
-					gamma[core.VarExpr(name)] = core.PolyType(set(), new_type_var)
-
-			# Apply inference, and add constraints on our monotype variables.
-			for decl in component:
-				if isinstance(decl, core.Declaration):
-					type_expr = self.J(gamma, decl.expr, depth=depth+1)
-					self.unification_context.equate(name_types[decl.name], type_expr)
-				elif isinstance(decl, core.ReturnStatement):
-					type_expr = self.J(gamma, decl.expr, depth=depth+1)
-					# TODO: XXX: Appropriately unify with a return type variable.
-					self.unification_context.equate(gamma.return_monotype, type_expr)
-				elif isinstance(decl, core.ExprEvaluation):
-					self.J(gamma, decl.expr, depth=depth+1)
-				else:
-					raise NotImplementedError("unhandled decl in inference: %r" % (decl,))
-
-			# Generalize the monotypes into polytypes, and update the context.
-			# We ignore a subset of the CodeBlock.Entry types, because they have no additional info to propagate.
-			ignored_types = (core.ReturnStatement,)
-			for decl in component:
-				if isinstance(decl, core.Declaration):
-					type_var = name_types[decl.name]
-					poly_type = self.contextual_generalization(
-						gamma,
-						self.unification_context.most_specific_type(type_var),
-					)
-					gamma[core.VarExpr(decl.name)] = poly_type
-					# Store the inferred type into the Declaration.
-					decl.type_annotation = poly_type
-				elif isinstance(decl, ignored_types):
-					pass
-				else:
-					raise NotImplementedError("unhandled decl in inference: %r" % (decl,))
-
-#			print "Gamma:", gamma
+		if self.stats is not None:
+			self.stats.record_components(strongly_connected_components)
+
+		if self.jobs > 1 and depth == 0:
+			self.infer_components_in_parallel(gamma, strongly_connected_components, levels)
+		else:
+			# Compute typing for each strongly connected component together.
+			for component in strongly_connected_components:
+				print "=== Inference for component:", component
+				key = self.cache_key(gamma, component) if depth == 0 else None
+				annotations = self.cache.lookup(key) if key is not None else None
+				if annotations is not None:
+					self.annotate(gamma, component, annotations)
+					continue
+				self.infer_component(gamma, component, depth=depth)
+				if key is not None:
+					self.cache.store(key, self.annotations(component))
 
 		# Replace the return monotype with the most specific available.
 		code_block.return_monotype = self.unification_context.most_specific_type(code_block.return_monotype)
 
+	def infer_component(self, gamma, component, depth=0):
+		"""infer_component(gamma, component) -> None
+
+		Infers the types of a strongly connected component of a code block's entries together, and binds its generalized declarations in gamma.
+		"""
+		if self.stats is not None:
+			start = time.time()
+		name_types = {}
+		# Each component is inferred one let-depth deeper, so that its own variables may be generalized.
+		self.level += 1
+
+		# Add fresh monotype variables to our system for the names declared in this component.
+		for decl in component:
+			for name in decl.provided_names():
+				new_type_var = name_types[name] = self.new_type()
+				gamma[core.VarExpr(name)] = core.PolyType(set(), new_type_var)
+
+		# Apply inference, and add constraints on our monotype variables.
+		for decl in component:
+			if isinstance(decl, core.Declaration):
+				type_expr = self.J(gamma, decl.expr, depth=depth+1)
+				self.unification_context.equate(name_types[decl.name], type_expr)
+			elif isinstance(decl, core.ReturnStatement):
+				type_expr = self.J(gamma, decl.expr, depth=depth+1)
+				# TODO: XXX: Appropriately unify with a return type variable.
+				self.unification_context.equate(gamma.return_monotype, type_expr)
+			elif isinstance(decl, core.ExprEvaluation):
+				self.J(gamma, decl.expr, depth=depth+1)
+			else:
+				raise NotImplementedError("unhandled decl in inference: %r" % (decl,))
+
+		self.level -= 1
+		self.unification_context.check_occurs()
+
+		# Generalize the monotypes into polytypes, and update the context.
+		# We ignore a subset of the CodeBlock.Entry types, because they have no additional info to propagate.
+		ignored_types = (core.ReturnStatement,)
+		for decl in component:
+			if isinstance(decl, core.Declaration):
+				type_var = name_types[decl.name]
+				poly_type = self.generalize(
+					self.unification_context.most_specific_type(type_var),
+				)
+				gamma[core.VarExpr(decl.name)] = poly_type
+				# Store the inferred type into the Declaration.
+				decl.type_annotation = poly_type
+			elif isinstance(decl, ignored_types):
+				pass
+			else:
+				raise NotImplementedError("unhandled decl in inference: %r" % (decl,))
+
+		if self.stats is not None:
+			self.stats.record_component_time(component, time.time() - start)
+#		print "Gamma:", gamma
+
+	def closed_context(self, gamma, component):
+		"""closed_context(gamma, component) -> {name: PolyType} for everything component depends on, or None
+
+		Returns None if the component can't be inferred independently of our unification context, because it depends on a type that isn't closed, or it's not made only of declarations.
+		"""
+		if not all(isinstance(decl, core.Declaration) for decl in component):
+			return None
+		names = set()
+		for decl in component:
+			names |= decl.name_deps()
+		for decl in component:
+			names -= decl.provided_names()
+		context = {}
+		for name in names:
+			var = core.VarExpr(name)
+			if var not in gamma:
+				continue
+			poly_t = gamma[var]
+			if poly_t.free_type_variables():
+				return None
+			context[name] = poly_t
+		return context
+
+	def annotations(self, component):
+		"""annotations(component) -> a picklable list of what inference found for each of component's annotated_nodes, in order
+
+		Types are made most specific, and a method call's impl is given by its index in our TraitResolver's impls.
+		"""
+		most_specific_type = self.unification_context.most_specific_type
+		result = []
+		for node in annotated_nodes(component):
+			if isinstance(node, core.Declaration):
+				poly_t = node.type_annotation
+				result.append(core.PolyType(poly_t.binders, most_specific_type(poly_t.mono)))
+			elif isinstance(node, core.CodeBlock):
+				result.append(None if node.return_monotype is None else most_specific_type(node.return_monotype))
+			elif node.impl is None:
+				result.append(None)
+			else:
+				if self.impl_indices is None:
+					self.impl_indices = {id(impl): i for i, impl in enumerate(self.traits.impls)}
+				result.append(self.impl_indices[id(node.impl)])
+		return result
+
+	def annotate(self, gamma, component, annotations):
+		"""annotate(gamma, component, annotations) -> None
+
+		Applies annotations, as returned by annotations() (perhaps in another process or run), to component's own nodes, and binds its declarations in gamma.
+		Their type variables are renamed apart from ours.
+		"""
+		subs = {}
+		for node, annotation in zip(annotated_nodes(component), annotations):
+			if isinstance(node, core.Declaration):
+				node.type_annotation = freshen(annotation, subs)
+			elif isinstance(node, core.CodeBlock):
+				node.return_monotype = freshen(annotation, subs)
+			else:
+				node.impl = None if annotation is None else self.traits.impls[annotation]
+		for decl in component:
+			gamma[core.VarExpr(decl.name)] = decl.type_annotation
+
+	def cache_key(self, gamma, component):
+		"""cache_key(gamma, component) -> component's key in our cache, or None if it can't be cached (or we have no cache)"""
+		if self.cache is None:
+			return None
+		context = self.closed_context(gamma, component)
+		if context is None:
+			return None
+		return self.cache.key(component, context, None if self.traits is None else self.traits.signature())
+
+	def infer_components_in_parallel(self, gamma, components, levels):
+		"""infer_components_in_parallel(gamma, components, levels) -> None
+
+		Infers components level by level, farming out each level's closed components to a process pool.
+		The workers' annotations are applied to the components, and their declarations bound in gamma, before the next level starts.
+		"""
+		by_level = {}
+		for component, level in zip(components, levels):
+			by_level.setdefault(level, []).append(component)
+		pool = multiprocessing.Pool(self.jobs)
+		try:
+			for level in sorted(by_level):
+				tasks, keys, local = [], [], []
+				for component in by_level[level]:
+					key = self.cache_key(gamma, component)
+					annotations = self.cache.lookup(key) if key is not None else None
+					if annotations is not None:
+						self.annotate(gamma, component, annotations)
+						continue
+					context = self.closed_context(gamma, component)
+					if context is None:
+						local.append(component)
+					else:
+						tasks.append((component, context, self.traits))
+						keys.append(key)
+				print "=== Inference for level %i: %i components in parallel, %i locally" % (level, len(tasks), len(local))
+				for (component, _, _), key, annotations in zip(tasks, keys, pool.map(infer_component_in_worker, tasks)):
+					self.annotate(gamma, component, annotations)
+					if key is not None:
+						self.cache.store(key, annotations)
+				for component in local:
+					self.infer_component(gamma, component)
+		finally:
+			pool.close()
+			pool.join()
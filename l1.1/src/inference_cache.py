@@ -0,0 +1,75 @@
+#!/usr/bin/python
+"""
+inference_cache.py
+
+A persistent cache of inferred top-level components, so that re-running inference on an edited file only re-infers what the edit could have affected.
+
+Each component is keyed on a hash of its declarations' lowered expressions, along with the (alpha-canonicalized) PolyTypes of every name it depends on, and the signatures of the impls that method calls might resolve to.
+So editing a function re-infers its component, but its dependents are only re-inferred if its type actually changed.
+Only components that Inference.closed_context accepts are cached, as only they can't depend on, or constrain, anything else in the unification context.
+What's cached for a component is its Inference.annotations, which refer to nothing but types and impl indices, so they're applied to the freshly lowered program as is.
+"""
+
+import os, hashlib, cPickle
+import inference
+
+# Bumped whenever what's cached changes, so that old cache files just miss.
+FORMAT = "2"
+
+def fingerprint(h, obj):
+	"""fingerprint(h, obj) -> None
+
+	Feeds a serialization of the lowered program fragment obj into the hash h.
+	Pickles are stable from run to run (unlike ids), as long as Python isn't run with hash randomization (-R).
+	"""
+	h.update(cPickle.dumps(obj, 2))
+
+def fingerprint_poly_type(h, poly_t):
+	# Type variable ids differ from run to run, so we key on the alpha-canonical form.
+	# Closed PolyTypes bind every variable they mention, so the canonical monotype says everything.
+	assert not poly_t.free_type_variables()
+	fingerprint(h, inference.alpha_canonicalize(poly_t.mono))
+
+class InferenceCache:
+	def __init__(self, path):
+		self.path = path
+		# Maps keys to pickled Inference.annotations.
+		self.entries = {}
+		if os.path.exists(path):
+			with open(path, "rb") as f:
+				self.entries = cPickle.load(f)
+		self.hits = 0
+		self.misses = 0
+
+	def key(self, component, context, impls=None):
+		"""key(component, context, impls=None) -> hash of component's declarations, the types in context of the names they depend on, and the impls signature (see traits.TraitResolver.signature)"""
+		h = hashlib.sha1()
+		h.update(FORMAT)
+		# Method calls are typed by the impls they resolve to, so any change to the impls invalidates everything.
+		if impls is not None:
+			fingerprint(h, impls)
+		# Components are sets, so hash their declarations in a canonical order.
+		for decl in sorted(component, key=lambda decl: decl.name):
+			fingerprint(h, decl)
+		for name in sorted(context):
+			h.update("%s :" % (name,))
+			fingerprint_poly_type(h, context[name])
+		return h.hexdigest()
+
+	def lookup(self, key):
+		"""lookup(key) -> the annotations stored under key, to be applied with Inference.annotate, or None"""
+		if key not in self.entries:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return cPickle.loads(self.entries[key])
+
+	def store(self, key, annotations):
+		self.entries[key] = cPickle.dumps(annotations, 2)
+
+	def save(self):
+		# Write to a temporary file first, so an interrupted run can't leave a truncated cache behind.
+		temp_path = self.path + ".tmp"
+		with open(temp_path, "wb") as f:
+			cPickle.dump(self.entries, f, 2)
+		os.rename(temp_path, self.path)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+"""
+inference_stats.py
+
+Opt-in statistics about a run of inference, for finding out where its time goes.
+
+Collection costs nothing unless asked for: Inference only checks for an InferenceStats once per code block and per component.
+The per-unification counts come from CountingUnificationContext and CountingGamma, which Inference only substitutes for the plain classes when it has an InferenceStats.
+Components inferred in worker processes (see Inference's jobs) aren't counted, beyond their number and sizes.
+"""
+
+import time, json, collections
+import inference
+
+class InferenceStats:
+	def __init__(self):
+		self.equate_calls = 0
+		self.find_calls = 0
+		# Histogram of the number of parent links followed by each find() call.
+		self.find_path_lengths = collections.Counter()
+		self.fresh_type_variables = 0
+		self.components = 0
+		# Histogram of the number of entries in each strongly connected component.
+		self.component_sizes = collections.Counter()
+		# A list of (names provided by the component, seconds taken to infer it).
+		self.component_seconds = []
+		self.gamma_copies = 0
+		# Histograms of the scope chain length, and of the number of bindings in scope, of each copied Gamma.
+		self.gamma_copy_depths = collections.Counter()
+		self.gamma_copy_sizes = collections.Counter()
+
+	def unification_context(self):
+		return CountingUnificationContext(self)
+
+	def scope(self, gamma):
+		"""scope(gamma) -> gamma.copy(), as a CountingGamma, whose copies are counted in turn"""
+		if isinstance(gamma, CountingGamma):
+			return gamma.copy()
+		return CountingGamma(gamma, self)
+
+	def record_components(self, components):
+		self.components += len(components)
+		for component in components:
+			self.component_sizes[len(component)] += 1
+
+	def record_component_time(self, component, seconds):
+		names = sorted(name for decl in component for name in decl.provided_names())
+		self.component_seconds.append((names, seconds))
+
+	def to_json(self):
+		return {
+			"equate_calls": self.equate_calls,
+			"find_calls": self.find_calls,
+			"find_path_lengths": self.find_path_lengths,
+			"fresh_type_variables": self.fresh_type_variables,
+			"components": self.components,
+			"component_sizes": self.component_sizes,
+			"component_seconds": [
+				{"names": names, "seconds": seconds}
+				for names, seconds in self.component_seconds
+			],
+			"total_component_seconds": sum(seconds for _, seconds in self.component_seconds),
+			"gamma_copies": self.gamma_copies,
+			"gamma_copy_depths": self.gamma_copy_depths,
+			"gamma_copy_sizes": self.gamma_copy_sizes,
+		}
+
+	def save(self, path):
+		with open(path, "w") as f:
+			json.dump(self.to_json(), f, indent=2, sort_keys=True)
+
+class CountingUnificationContext(inference.UnificationContext):
+	def __init__(self, stats):
+		inference.UnificationContext.__init__(self)
+		self.stats = stats
+
+	def equate(self, t1, t2):
+		self.stats.equate_calls += 1
+		inference.UnificationContext.equate(self, t1, t2)
+
+	def find(self, id):
+		stats = self.stats
+		stats.find_calls += 1
+		parents = self.parents
+		length = 0
+		if id < len(parents):
+			node = id
+			while parents[node] != node:
+				node = parents[node]
+				length += 1
+		stats.find_path_lengths[length] += 1
+		return inference.UnificationContext.find(self, id)
+
+	def set_level(self, id, level):
+		# Every fresh type variable gets its level set exactly once, when it's created.
+		self.stats.fresh_type_variables += 1
+		inference.UnificationContext.set_level(self, id, level)
+
+class CountingGamma(inference.Gamma):
+	__slots__ = "stats",
+
+	def __init__(self, parent, stats):
+		inference.Gamma.__init__(self, parent)
+		self.stats = stats
+
+	def copy(self):
+		stats = self.stats
+		stats.gamma_copies += 1
+		depth = size = 0
+		gamma = self
+		while gamma is not None:
+			depth += 1
+			size += len(gamma.context)
+			gamma = gamma.parent
+		stats.gamma_copy_depths[depth] += 1
+		stats.gamma_copy_sizes[size] += 1
+		return CountingGamma(self, stats)
@@ -3,6 +3,9 @@
 import enum, argparse
 import parsing
 import inference
+import inference_cache
+import inference_stats
+import traits
 import core
 import utils
 
@@ -38,8 +41,14 @@ class Lowerer:
 		self.top_level[ast["name"]] = trait
 
 	def handle_implDeclaration(self, code_block, ast):
-		trait_expr = self.lower_type(ast["trait"])
-		type_expr = self.lower_type(ast["forType"])
+		# The impl's quantified type parameters become type variables, which trait resolution may bind.
+		# TODO: Check their bounds during trait resolution.
+		type_params = {
+			core.AppType(param_name, []): inference.global_new_type()
+			for param_name, optional_bound in ast["quantifiedTypeParams"]
+		}
+		trait_expr = self.lower_type(ast["trait"]).apply_type_subs(type_params)
+		type_expr = self.lower_type(ast["forType"]).apply_type_subs(type_params)
 		impl = core.Impl(trait_expr, type_expr)
 		self.add_code_block(impl.code_block, ast["body"])
 		self.top_level.impls.append(impl)
@@ -166,6 +175,9 @@ class Lowerer:
 if __name__ == "__main__":
 	p = argparse.ArgumentParser()
 	p.add_argument("source")
+	p.add_argument("--jobs", type=int, default=None, help="Infer independent top-level components in a pool of this many processes.")
+	p.add_argument("--cache", default=None, help="Reuse inferred types of unchanged top-level components from this file, and update it.")
+	p.add_argument("--stats", default=None, help="Write statistics about inference to this file, as JSON.")
 	args = p.parse_args()
 
 	with open(args.source) as f:
@@ -185,8 +197,16 @@ if __name__ == "__main__":
 	root_gamma = prelude.make_gamma()
 
 	# Do inference.
-	inf = inference.Inference()
+	cache = inference_cache.InferenceCache(args.cache) if args.cache is not None else None
+	stats = inference_stats.InferenceStats() if args.stats is not None else None
+	inf = inference.Inference(jobs=args.jobs, cache=cache, traits=traits.TraitResolver(lowerer.top_level.impls), stats=stats)
+	inf.infer_impls(root_gamma)
 	inf.infer_code_block(root_gamma, lowerer.top_level.root_block)
+	if cache is not None:
+		cache.save()
+		print "Inference cache: %i hits, %i misses" % (cache.hits, cache.misses)
+	if stats is not None:
+		stats.save(args.stats)
 
 	print "=" * 20, "Inference complete."
 
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+"""
+traits.py
+
+Statically resolves method calls to the impls that provide them.
+
+Impls are indexed by trait, and then by the head constructor of the type they're for, so a query only tests the few impls that could possibly apply.
+An impl applies to a receiver type if its for type matches it one way: the impl's type variables may be bound, but the receiver's are opaque.
+So the answer to a query depends only on the receiver type up to renaming, and is memoized by the method name and the alpha-canonicalized receiver type.
+"""
+
+import core
+import inference
+
+class ResolutionError(Exception):
+	pass
+
+def match(pattern, t, subs):
+	"""match(pattern, t, subs) -> True if binding pattern's variables (extending subs) makes pattern equal to t"""
+	if isinstance(pattern, core.VarType):
+		if pattern in subs:
+			return subs[pattern] == t
+		subs[pattern] = t
+		return True
+	if not isinstance(t, core.AppType) or t.constructor != pattern.constructor or len(t.args) != len(pattern.args):
+		return False
+	return all(match(p, arg, subs) for p, arg in zip(pattern.args, t.args))
+
+def head_constructor(t):
+	"""head_constructor(t) -> the constructor of t, or None if t is a type variable"""
+	return t.constructor if isinstance(t, core.AppType) else None
+
+class TraitResolver:
+	def __init__(self, impls):
+		self.impls = impls
+		# by_trait[trait name][head constructor] is the list of impls of that trait for types with that head.
+		# Impls for a bare type variable are filed under the head None.
+		self.by_trait = {}
+		# traits_providing[method name] is the set of names of the traits with an impl that provides that method.
+		self.traits_providing = {}
+		for impl in impls:
+			trait_name = impl.trait_expr.constructor
+			self.by_trait.setdefault(trait_name, {}).setdefault(head_constructor(impl.type_expr), []).append(impl)
+			for entry in impl.code_block.entries:
+				for name in entry.provided_names():
+					self.traits_providing.setdefault(name, set()).add(trait_name)
+		# Maps (method name, alpha-canonical receiver type) to the resolved impl, or None.
+		self.memo = {}
+
+	def candidates(self, method_name, head):
+		for trait_name in self.traits_providing.get(method_name, ()):
+			by_head = self.by_trait[trait_name]
+			for impl in by_head.get(head, []) + by_head.get(None, []):
+				if any(method_name in entry.provided_names() for entry in impl.code_block.entries):
+					yield impl
+
+	def resolve(self, method_name, receiver_t):
+		"""resolve(method_name, receiver_t) -> the impl that provides method_name for receiver_t, or None
+
+		receiver_t must be a most specific type.
+		Returns None if no impl applies, or if receiver_t is still a type variable, in which case the call can't be resolved statically.
+		Raises ResolutionError if more than one impl applies.
+		"""
+		if isinstance(receiver_t, core.VarType):
+			return None
+		key = method_name, inference.alpha_canonicalize(receiver_t)
+		if key in self.memo:
+			return self.memo[key]
+		matches = [
+			impl for impl in self.candidates(method_name, receiver_t.constructor)
+			if match(impl.type_expr, receiver_t, {})
+		]
+		if len(matches) > 1:
+			raise ResolutionError("Ambiguous method %s for %r, provided by: %s" % (
+				method_name,
+				receiver_t,
+				", ".join("%r for %r" % (impl.trait_expr, impl.type_expr) for impl in matches),
+			))
+		result = self.memo[key] = matches[0] if matches else None
+		return result
+
+	def method_type(self, impl, method_name):
+		"""method_type(impl, method_name) -> the PolyType of impl's method, or None if it hasn't been inferred"""
+		for entry in impl.code_block.entries:
+			if method_name not in entry.provided_names():
+				continue
+			if isinstance(entry, core.Stub):
+				return core.PolyType(entry.type_expr.free_type_variables(), entry.type_expr)
+			if isinstance(entry, core.Declaration) and not isinstance(entry.type_annotation.mono, core.HoleType):
+				return entry.type_annotation
+		return None
+
+	def signature(self):
+		"""signature() -> a picklable description of every impl and its method types, stable from run to run"""
+		result = []
+		for impl in self.impls:
+			methods = []
+			for entry in impl.code_block.entries:
+				for name in sorted(entry.provided_names()):
+					poly_t = self.method_type(impl, name)
+					methods.append((name, None if poly_t is None else inference.alpha_canonicalize(poly_t.mono)))
+			# The trait and for type share the impl's type variables, so canonicalize them together.
+			subs = {}
+			result.append((
+				inference.alpha_canonicalize(impl.trait_expr, subs),
+				inference.alpha_canonicalize(impl.type_expr, subs),
+				methods,
+			))
+		return result
@@ -1,15 +1,41 @@
 #!/usr/bin/python
 
-import unittest
+import os, sys, json, unittest, tempfile
+import core
+import dependency
+import inference
+import inference_cache
+import inference_stats
+import traits
 from inference import *
 
+def fun(*types):
+	return core.AppType("fun", list(types))
+
+def abs_expr(arg_name, result_expr):
+	return core.AbsExpr([arg_name], [core.HoleType()], result_expr, core.HoleType())
+
+def app_expr(fn_expr, arg_expr):
+	return core.AppExpr(fn_expr, [arg_expr])
+
+def declaration(name, expr):
+	return core.Declaration(name, expr, core.PolyType(set(), core.HoleType()))
+
+def code_block(declarations, return_expr=None):
+	block = core.CodeBlock()
+	for name, expr in declarations:
+		block.add(declaration(name, expr))
+	if return_expr is not None:
+		block.add(core.ReturnStatement(return_expr))
+	return block
+
 class Tests(unittest.TestCase):
 	def setUp(self):
-		self.a = MonoType("var", "a")
-		self.b = MonoType("var", "b")
-		self.c = MonoType("var", "c")
-		self.t_int = MonoType("link", [], link_name="int")
-		self.t_bool = MonoType("link", [], link_name="bool")
+		self.a = global_new_type()
+		self.b = global_new_type()
+		self.c = global_new_type()
+		self.t_int = core.AppType("int", [])
+		self.t_bool = core.AppType("bool", [])
 
 	def test_unification(self):
 		"""Make sure that unification actually unifies types."""
@@ -20,15 +46,66 @@ class Tests(unittest.TestCase):
 		# After unification the two type variables must be equal.
 		self.assertTrue(inf.unification_context.must_equal(self.a, self.b))
 
+	def test_union_find(self):
+		"""Make sure that links propagate through unions, whichever side they start on."""
+		u = UnificationContext()
+		d = global_new_type()
+		u.equate(self.a, fun(self.t_int, self.c))
+		u.equate(fun(d, self.t_bool), self.b)
+		# This unions two sets that both have links, so it must unify the links too.
+		u.equate(self.a, self.b)
+		self.assertTrue(u.must_equal(self.a, self.b))
+		self.assertEqual(u.most_specific_type(self.c), self.t_bool)
+		self.assertEqual(u.most_specific_type(d), self.t_int)
+		self.assertEqual(u.most_specific_type(self.a), fun(self.t_int, self.t_bool))
+		# Copies must not share state with the original.
+		v = u.copy()
+		v.equate(self.t_int, self.t_int)
+		v.equate(global_new_type(), self.a)
+		self.assertRaises(UnificationError, v.equate, self.a, fun(self.t_bool, self.t_bool))
+		self.assertEqual(u.most_specific_type(self.a), fun(self.t_int, self.t_bool))
+
+	def test_snapshot_rollback(self):
+		"""Make sure that rolling back undoes exactly the unifications made since the snapshot."""
+		u = UnificationContext()
+		u.equate(self.a, fun(self.b, self.t_int))
+		outer = u.snapshot()
+		u.equate(self.b, self.c)
+		inner = u.snapshot()
+		u.equate(self.c, self.t_bool)
+		self.assertEqual(u.most_specific_type(self.a), fun(self.t_bool, self.t_int))
+		u.rollback(inner)
+		self.assertTrue(u.must_equal(self.b, self.c))
+		self.assertTrue(isinstance(u.most_specific_type(self.c), core.VarType))
+		u.rollback(outer)
+		self.assertFalse(u.must_equal(self.b, self.c))
+		self.assertEqual(u.most_specific_type(self.a), fun(self.b, self.t_int))
+		# A failed speculative unification must leave no trace, even though it bound b before failing.
+		self.assertFalse(u.try_equate(self.a, fun(self.t_bool, self.t_bool)))
+		self.assertEqual(u.most_specific_type(self.a), fun(self.b, self.t_int))
+		self.assertTrue(u.try_equate(self.a, fun(self.t_bool, self.t_int)))
+		self.assertEqual(u.most_specific_type(self.b), self.t_bool)
+		self.assertTrue(u.trail is None)
+
+	def test_most_specific_type_caching(self):
+		"""Make sure that cached most specific types are reused, and invalidated by later unifications."""
+		u = UnificationContext()
+		t = fun(self.t_int, self.t_bool)
+		# Already most specific types come back as is.
+		self.assertTrue(u.most_specific_type(t) is t)
+		u.equate(self.a, fun(self.b, self.b))
+		first = u.most_specific_type(self.a)
+		self.assertTrue(u.most_specific_type(self.a) is first)
+		u.equate(self.b, self.t_int)
+		self.assertEqual(u.most_specific_type(self.a), fun(self.t_int, self.t_int))
+		snapshot = u.snapshot()
+		u.equate(self.c, self.a)
+		u.rollback(snapshot)
+		self.assertEqual(u.most_specific_type(self.c), self.c)
+
 	def test_alpha_canonicalization(self):
 		"""Make sure that a test type unifies with its canonicalization."""
-		t = MonoType("link", [
-			MonoType("var", "a"),
-			MonoType("link", [
-				MonoType("var", "b"),
-				MonoType("var", "a"),
-			], link_name="fun"),
-		], link_name="fun")
+		t = fun(self.a, fun(self.b, self.a))
 		alpha_canon = alpha_canonicalize(t)
 		double_alpha_canon = alpha_canonicalize(alpha_canon)
 		# Demand idempotency of alpha canonicalization, at least at this one type.
@@ -46,29 +123,14 @@ class Tests(unittest.TestCase):
 		inf = Inference()
 		# Encode the expression:
 		#   (\x -> x)(\x -> \y -> x)
-		expr = Expr("app", [
-			Expr("abs", [
-				Expr("var", "x"),
-				Expr("var", "x"),
-			]),
-			Expr("abs", [
-				Expr("var", "x"),
-				Expr("abs", [
-					Expr("var", "y"),
-					Expr("var", "x"),
-				]),
-			]),
-		])
+		expr = app_expr(
+			abs_expr("x", core.VarExpr("x")),
+			abs_expr("x", abs_expr("y", core.VarExpr("x"))),
+		)
 		# This should yield the type: a -> b -> a.
-		expected_type = MonoType("link", [
-			MonoType("var", "a"),
-			MonoType("link", [
-				MonoType("var", "b"),
-				MonoType("var", "a"),
-			], link_name="fun"),
-		], link_name="fun")
+		expected_type = fun(self.a, fun(self.b, self.a))
 		# Do type inference.
-		final_type = inf.J({}, expr)
+		final_type = inf.J(Gamma(), expr)
 		final_type = inf.unification_context.most_specific_type(final_type)
 		self.assertEqual(
 			alpha_canonicalize(final_type),
@@ -81,84 +143,264 @@ class Tests(unittest.TestCase):
 		# Encode the expression:
 		#   let inner = (\x -> \y -> (x y)) in
 		#   let id = (\x -> x) in (id id)(inner)
-		inner_func = Expr("abs", [
-			Expr("var", "x"),
-			Expr("abs", [
-				Expr("var", "y"),
-				Expr("app", [
-					Expr("var", "x"),
-					Expr("var", "y"),
-				]),
-			]),
-		])
-		id_func = Expr("abs", [
-			Expr("var", "z"),
-			Expr("var", "z"),
-		])
-		expr = Expr("let", [
-			Expr("var", "inner"),
+		inner_func = abs_expr("x", abs_expr("y", app_expr(core.VarExpr("x"), core.VarExpr("y"))))
+		id_func = abs_expr("z", core.VarExpr("z"))
+		expr = core.LetExpr(
+			"inner",
 			inner_func,
-			Expr("let", [
-				Expr("var", "id"),
+			core.LetExpr(
+				"id",
 				id_func,
-				Expr("app", [
-					Expr("app", [
-						Expr("var", "id"),
-						Expr("var", "id"),
-					]),
-					Expr("var", "inner"),
-				]),
-			]),
-		])
+				app_expr(
+					app_expr(core.VarExpr("id"), core.VarExpr("id")),
+					core.VarExpr("inner"),
+				),
+			),
+		)
 		# This should yield the type: (a - > b) -> a -> b.
-		expected_type = MonoType("link", [
-			MonoType("link", [
-				MonoType("var", "a"),
-				MonoType("var", "b"),
-			], link_name="fun"),
-			MonoType("link", [
-				MonoType("var", "a"),
-				MonoType("var", "b"),
-			], link_name="fun"),
-		], link_name="fun")
+		expected_type = fun(fun(self.a, self.b), fun(self.a, self.b))
 		# Do type inference.
-		final_type = inf.J({}, expr)
+		final_type = inf.J(Gamma(), expr)
 		final_type = inf.unification_context.most_specific_type(final_type)
 		self.assertEqual(
 			alpha_canonicalize(final_type),
 			alpha_canonicalize(expected_type),
 		)
 
+	def test_let_generalization_levels(self):
+		"""Test that let doesn't generalize type variables still in use by the context."""
+		inf = Inference()
+		# Encode the expression:
+		#   \x -> let y = x in let u = y(1) in x
+		# If y's type were wrongly generalized then y(1) wouldn't constrain x.
+		expr = abs_expr("x", core.LetExpr(
+			"y",
+			core.VarExpr("x"),
+			core.LetExpr(
+				"u",
+				app_expr(core.VarExpr("y"), core.LiteralExpr(1)),
+				core.VarExpr("x"),
+			),
+		))
+		# This should yield the type: (int -> a) -> int -> a.
+		expected_type = fun(fun(self.t_int, self.a), fun(self.t_int, self.a))
+		final_type = inf.J(Gamma(), expr)
+		final_type = inf.unification_context.most_specific_type(final_type)
+		self.assertEqual(
+			alpha_canonicalize(final_type),
+			alpha_canonicalize(expected_type),
+		)
+
+	def test_occurs_check(self):
+		"""Test that infinite types are reported rather than looped on."""
+		inf = Inference()
+		# Encode the expression:
+		#   let f = \x -> x(x) in f
+		self_app = abs_expr("x", app_expr(core.VarExpr("x"), core.VarExpr("x")))
+		expr = core.LetExpr("f", self_app, core.VarExpr("f"))
+		self.assertRaises(UnificationError, inf.J, Gamma(), expr)
+		# The infinite type needn't be reachable from any type we generalize, e.g.:
+		#   z = const1(\x -> x(x))
+		# where const1 : forall a, a -> int
+		gamma = Gamma()
+		gamma[core.VarExpr("const1")] = core.PolyType(set([self.a]), fun(self.a, self.t_int))
+		const_self_app = app_expr(core.VarExpr("const1"), self_app)
+		block = code_block([("z", const_self_app)])
+		self.assertRaises(UnificationError, Inference().infer_code_block, gamma, block)
+		expr = core.LetExpr("z", const_self_app, core.VarExpr("z"))
+		self.assertRaises(UnificationError, Inference().J, gamma, expr)
+		# The cycle may also be closed indirectly, through another variable's link.
+		u = UnificationContext()
+		u.equate(self.a, fun(self.b))
+		u.equate(self.b, fun(self.t_int, self.c))
+		u.equate(self.c, self.a)
+		self.assertRaises(UnificationError, u.most_specific_type, self.b)
+
+	def test_parallel_components(self):
+		"""Test that inferring independent components in worker processes gives the same types as inferring them in order."""
+		def make_block():
+			return code_block([
+				("id", abs_expr("x", core.VarExpr("x"))),
+				("k", abs_expr("x", abs_expr("y", core.VarExpr("x")))),
+				("one", app_expr(core.VarExpr("id"), core.LiteralExpr(1))),
+				("f", abs_expr("x", app_expr(core.VarExpr("k"), app_expr(core.VarExpr("id"), core.VarExpr("x"))))),
+				("g", abs_expr("x", app_expr(app_expr(core.VarExpr("f"), core.VarExpr("one")), core.VarExpr("x")))),
+				("h", abs_expr("x", core.BlockExpr(code_block([("y", app_expr(core.VarExpr("k"), core.VarExpr("x")))], core.VarExpr("y"))))),
+			], core.VarExpr("one"))
+		results = []
+		for jobs in (None, 2):
+			block = make_block()
+			exprs = [entry.expr for entry in block.entries]
+			first_id = inference.global_type_counter + 1
+			Inference(jobs=jobs).infer_code_block(Gamma(), block)
+			decls = list(annotated_nodes([entry for entry in block.entries if isinstance(entry, core.Declaration)]))
+			results.append([
+				(decl.name, len(decl.type_annotation.binders), alpha_canonicalize(decl.type_annotation.mono))
+				for decl in decls
+				if isinstance(decl, core.Declaration)
+			])
+			self.assertEqual(block.return_monotype, self.t_int)
+			# The declarations are annotated in place.
+			self.assertTrue(all(entry.expr is expr for entry, expr in zip(block.entries, exprs)))
+			# Every quantified type variable is our own, and distinct from every other declaration's.
+			ids = [v.id for decl in block.entries if isinstance(decl, core.Declaration) for v in decl.type_annotation.binders]
+			self.assertEqual(len(ids), len(set(ids)))
+			self.assertTrue(all(first_id <= id <= inference.global_type_counter for id in ids))
+		self.assertEqual(results[0], results[1])
+		self.assertEqual([name for name, _, _ in results[0]], ["id", "k", "one", "f", "g", "h", "y"])
+
+	def test_inference_cache(self):
+		"""Test that the inference cache persists, and re-infers exactly the components whose inputs changed."""
+		def infer(path, k_body):
+			cache = inference_cache.InferenceCache(path)
+			block = code_block([
+				("id", abs_expr("x", core.VarExpr("x"))),
+				("k", abs_expr("x", abs_expr("y", k_body))),
+				("f", abs_expr("x", app_expr(core.VarExpr("k"), core.VarExpr("x")))),
+				("g", abs_expr("x", app_expr(core.VarExpr("id"), core.VarExpr("x")))),
+			])
+			Inference(cache=cache).infer_code_block(Gamma(), block)
+			cache.save()
+			types = [alpha_canonicalize(decl.type_annotation.mono) for decl in block.entries]
+			return types, cache.hits, cache.misses
+		fd, path = tempfile.mkstemp()
+		os.close(fd)
+		os.remove(path)
+		try:
+			types, hits, misses = infer(path, core.VarExpr("x"))
+			self.assertEqual((hits, misses), (0, 4))
+			# A fresh cache loaded from disk has everything.
+			self.assertEqual(infer(path, core.VarExpr("x")), (types, 4, 0))
+			# Changing k's body but not its type only re-infers k.
+			x_again = app_expr(core.VarExpr("id"), core.VarExpr("x"))
+			self.assertEqual(infer(path, x_again), (types, 3, 1))
+			# Changing k's type re-infers its dependent f too.
+			new_types, hits, misses = infer(path, core.VarExpr("y"))
+			self.assertEqual((hits, misses), (2, 2))
+			self.assertNotEqual(new_types[2], types[2])
+		finally:
+			os.remove(path)
+
+	def test_inference_cache_annotations(self):
+		"""Test that a cache hit annotates the program's own nested declarations and method calls."""
+		t_str = core.AppType("str", [])
+		impl = core.Impl(core.AppType("Show", []), self.t_int)
+		impl.code_block.add(declaration("show", abs_expr("self", core.LiteralExpr("int"))))
+		resolver = traits.TraitResolver([impl])
+		Inference(traits=resolver).infer_impls(Gamma())
+		cache = inference_cache.InferenceCache(os.path.join(tempfile.gettempdir(), "never-saved.cache"))
+		for hits in (0, 1):
+			call = core.MethodCallExpr(core.LiteralExpr(1), "show", [])
+			inner = code_block([("s", call)], core.VarExpr("s"))
+			block = code_block([("f", abs_expr("x", core.BlockExpr(inner)))])
+			Inference(cache=cache, traits=resolver).infer_code_block(Gamma(), block)
+			self.assertEqual(cache.hits, hits)
+			self.assertTrue(call.impl is impl)
+			self.assertEqual(inner.entries[0].type_annotation.mono, t_str)
+			self.assertEqual(inner.return_monotype, t_str)
+			self.assertEqual(alpha_canonicalize(block.entries[0].type_annotation.mono), alpha_canonicalize(fun(self.a, t_str)))
+
+	def test_trait_resolution(self):
+		"""Test that method calls are resolved to the impl for their receiver's type, and typed by its method."""
+		t_vec = lambda t: core.AppType("Vec", [t])
+		def make_impl(type_expr, result_expr):
+			impl = core.Impl(core.AppType("Show", []), type_expr)
+			impl.code_block.add(declaration("show", abs_expr("self", result_expr)))
+			return impl
+		int_impl = make_impl(self.t_int, core.LiteralExpr("int"))
+		vec_impl = make_impl(t_vec(self.a), core.LiteralExpr(0))
+		resolver = traits.TraitResolver([int_impl, vec_impl])
+		inf = Inference(traits=resolver)
+		gamma = Gamma()
+		gamma[core.VarExpr("v")] = core.PolyType(set([self.b]), t_vec(self.b))
+		inf.infer_impls(gamma)
+		calls = [
+			core.MethodCallExpr(core.LiteralExpr(1), "show", []),
+			core.MethodCallExpr(core.VarExpr("v"), "show", []),
+			core.MethodCallExpr(core.VarExpr("v"), "show", []),
+			core.MethodCallExpr(core.LiteralExpr(1), "hide", []),
+		]
+		block = code_block([("r%i" % (i,), call) for i, call in enumerate(calls)])
+		inf.infer_code_block(gamma, block)
+		self.assertEqual([call.impl for call in calls], [int_impl, vec_impl, vec_impl, None])
+		types = [decl.type_annotation.mono for decl in block.entries]
+		self.assertEqual(types[:3], [core.AppType("str", []), self.t_int, self.t_int])
+		self.assertTrue(isinstance(types[3], core.VarType))
+		# Both calls on v have receivers of the same shape, so the second was answered from the memo.
+		self.assertEqual(len(resolver.memo), 3)
+		# A blanket impl overlaps with every other.
+		resolver = traits.TraitResolver([int_impl, make_impl(self.c, core.LiteralExpr(0))])
+		self.assertRaises(traits.ResolutionError, resolver.resolve, "show", self.t_int)
+
+	def test_inference_stats(self):
+		"""Test that collecting statistics doesn't change the inferred types, and counts what inference did."""
+		results = []
+		for stats in (None, inference_stats.InferenceStats()):
+			block = code_block([
+				("f", abs_expr("x", app_expr(core.VarExpr("g"), core.VarExpr("x")))),
+				("g", abs_expr("x", app_expr(core.VarExpr("f"), core.VarExpr("x")))),
+				("one", app_expr(core.VarExpr("f"), core.LiteralExpr(1))),
+			])
+			Inference(stats=stats).infer_code_block(Gamma(), block)
+			results.append([alpha_canonicalize(decl.type_annotation.mono) for decl in block.entries])
+		self.assertEqual(results[0], results[1])
+		# f and g are mutually recursive, so they're inferred together.
+		self.assertEqual(stats.components, 2)
+		self.assertEqual(stats.component_sizes, {1: 1, 2: 1})
+		self.assertEqual(sorted(names for names, _ in stats.component_seconds), [["f", "g"], ["one"]])
+		self.assertTrue(stats.equate_calls > 0)
+		self.assertEqual(sum(stats.find_path_lengths.values()), stats.find_calls)
+		# One type variable for the block's return type, one per declaration, lambda argument and application, and two instantiating f's binders.
+		self.assertEqual(stats.fresh_type_variables, 1 + 3 + 2 + 3 + 2)
+		# One copy per lambda.
+		self.assertEqual(stats.gamma_copies, 2)
+		json.dumps(stats.to_json())
+
+	def test_dependency_levels(self):
+		"""Test that components come dependencies first with correct levels, even for chains deeper than the recursion limit."""
+		g = dependency.DependencyManager(debug=True)
+		n = 5 * sys.getrecursionlimit()
+		for i in xrange(n - 1):
+			g.add_dep(i + 1, i)
+		# Close a cycle at the far end of the chain.
+		g.add_dep(n - 2, n - 1)
+		components, levels = g.strongly_connected_components_with_levels()
+		self.assertEqual(components[:3], [[0], [1], [2]])
+		self.assertEqual(sorted(components[-1]), [n - 2, n - 1])
+		self.assertEqual(levels, range(n - 1))
+
+	def test_gamma_scopes(self):
+		"""Test that extending a typing context neither mutates nor hides its parent."""
+		x, y = core.VarExpr("x"), core.VarExpr("y")
+		gamma = Gamma()
+		gamma[x] = core.PolyType(set(), self.t_int)
+		gamma.return_monotype = self.a
+		gamma_prime = gamma.copy()
+		gamma_prime[x] = core.PolyType(set(), self.t_bool)
+		gamma_prime[y] = core.PolyType(set(), self.t_int)
+		self.assertEqual(gamma_prime[x].mono, self.t_bool)
+		self.assertEqual(gamma[x].mono, self.t_int)
+		self.assertTrue(y in gamma_prime)
+		self.assertFalse(y in gamma)
+		self.assertRaises(KeyError, lambda: gamma[y])
+		self.assertEqual(gamma_prime.return_monotype, self.a)
+
 	def test_environment(self):
 		"""Test that typing environments can be read by variables."""
 		inf = Inference()
 		# Encode the expression:
 		#   dual \x -> (dual x)
 		# where dual : forall a b, (a -> b) -> b -> a
-		expr = Expr("app", [
-			Expr("var", "dual"),
-			Expr("abs", [
-				Expr("var", "x"),
-				Expr("app", [
-					Expr("var", "dual"),
-					Expr("var", "x"),
-				]),
-			]),
-		])
-		dual_type = PolyType(
-			set([MonoType("var", "a"), MonoType("var", "b")]),
-			MonoType("link", [
-				MonoType("link", [
-					MonoType("var", "a"),
-					MonoType("var", "b"),
-				], link_name="fun"),
-				MonoType("link", [
-					MonoType("var", "b"),
-					MonoType("var", "a"),
-				], link_name="fun"),
-			], link_name="fun"),
+		expr = app_expr(
+			core.VarExpr("dual"),
+			abs_expr("x", app_expr(core.VarExpr("dual"), core.VarExpr("x"))),
+		)
+		dual_type = core.PolyType(
+			set([self.a, self.b]),
+			fun(fun(self.a, self.b), fun(self.b, self.a)),
 		)
-		gamma = {Expr("var", "dual"): dual_type}
+		gamma = Gamma()
+		gamma[core.VarExpr("dual")] = dual_type
 		# This should yield type: (a -> b) -> b -> a, the same as dual's monotype.
 		expected_type = dual_type.mono
 		# Do type inference.
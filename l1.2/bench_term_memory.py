@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""
+bench_term_memory.py
+
+Reports how many bytes each kernel term node costs, on a few representative large terms.
+Usage: python bench_term_memory.py [size]
+"""
+
+import sys, time
+import easy
+
+def own_size(obj):
+	size = sys.getsizeof(obj)
+	# Instances without __slots__ also pay for their attribute dict.
+	if hasattr(obj, "__dict__"):
+		size += sys.getsizeof(obj.__dict__)
+	return size
+
+def children(obj):
+	names = list(getattr(obj, "__dict__", ()))
+	for cls in type(obj).__mro__:
+		names.extend(getattr(cls, "__slots__", ()))
+	for name in names:
+		value = getattr(obj, name, None)
+		if isinstance(value, (easy.Term, easy.Match.Arm)):
+			yield value
+		elif isinstance(value, (list, tuple)):
+			for item in value:
+				if isinstance(item, (easy.Term, easy.Match.Arm)):
+					yield item
+
+def measure(root):
+	"""measure(root) -> (node count, total bytes), counting each distinct node once."""
+	seen = set()
+	stack = [root]
+	total = 0
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		total += own_size(obj)
+		stack.extend(children(obj))
+	return len(seen), total
+
+def numeral(n):
+	term = easy.ConstructorRef("nat", "O")
+	for _ in xrange(n):
+		term = easy.Application(easy.ConstructorRef("nat", "S"), term)
+	return term
+
+def lambda_chain(n):
+	term = easy.Var("x0")
+	for i in xrange(n):
+		term = easy.Abstraction(easy.Var("x%i" % (i,)), easy.Var("nat"), easy.Application(term, easy.Var("x%i" % (i,))))
+	return term
+
+def substituted(n):
+	# Every level of subst allocates a fresh node, so this measures the nodes normalize and subst produce.
+	return lambda_chain(n).subst(easy.Var("nat"), numeral(1))
+
+def report(name, build, size):
+	start = time.time()
+	term = build(size)
+	elapsed = time.time() - start
+	nodes, total = measure(term)
+	print "%-16s %8i nodes %10i bytes %7.1f bytes/node (built in %.3fs)" % (name, nodes, total, total / float(nodes), elapsed)
+
+if __name__ == "__main__":
+	size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	sys.setrecursionlimit(max(sys.getrecursionlimit(), 4 * size))
+	report("numeral", numeral, size)
+	report("lambda_chain", lambda_chain, size)
+	report("substituted", substituted, size)
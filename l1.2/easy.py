@@ -7,10 +7,12 @@ import sys
 if __name__ == "__main__":
 	sys.modules["easy"] = sys.modules["__main__"]
 
-import enum, collections
+import enum, collections, itertools
 import easy_parse
 
-class HashableMixin:
+class HashableMixin(object):
+	__slots__ = ()
+
 	def __eq__(self, other):
 		return self.__class__ is other.__class__ and self.key() == other.key()
 
@@ -28,6 +30,118 @@ class EvalStrategy(enum.Enum):
 class TypeCheckFailure(Exception):
 	pass
 
+# Binders are renamed with a fresh number from here whenever a substitution would otherwise capture a variable.
+# The names have a ~ in them, which the parser never produces, so they can't clash with any written variable.
+fresh_var_numbers = itertools.count(1)
+
+def fresh_var(var):
+	"""fresh_var(var) -> a new variable named after var, distinct from every other variable"""
+	return Var("%s~%i" % (var.var.split("~")[0], next(fresh_var_numbers)))
+
+def resolved_free_vars(t):
+	"""resolved_free_vars(t) -> the free variables and unsolved metavariables of t, looking through the solutions of solved metavariables
+
+	alpha_key treats every metavariable as an opaque atom, but a solved one stands for its solution, whose variables can be captured too.
+	"""
+	free = alpha_key(t)[2]
+	for var in free:
+		if isinstance(var, Hole) and var.resolve() is not var:
+			return alpha_key(var.metas.zonk(t))[2]
+	return free
+
+def rename_apart(var, body, y):
+	"""rename_apart(var, body, y) -> (var', body'), binding the same as var in body, where var' isn't free in y
+
+	Substituting y under a binder only avoids capture once the binder has been renamed apart from y's free variables.
+	"""
+	if var not in resolved_free_vars(y):
+		return var, body
+	new_var = fresh_var(var)
+	return new_var, body.subst(var, new_var)
+
+# Every Context carries a generation number, and gets a fresh one whenever its definitions change.
+# Two contexts with the same generation therefore unfold every Var identically, which is what lets conversion results be reused.
+context_generations = itertools.count()
+
+class ConversionCache:
+	"""ConversionCache
+
+	A bounded LRU table of term pairs that have been proven convertible, keyed by context generation and alpha_key hashes.
+	A single cache is shared by a Context and every copy made of it.
+	"""
+	def __init__(self, max_entries=4096):
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict()
+		self.hits = self.misses = 0
+
+	def lookup(self, ctx, t1, t2):
+		h1, k1, _ = alpha_key(t1)
+		h2, k2, _ = alpha_key(t2)
+		for key, pair in (((ctx.generation, h1, h2), (k1, k2)), ((ctx.generation, h2, h1), (k2, k1))):
+			if self.entries.get(key) == pair:
+				# Reinsert to mark the entry as most recently used.
+				self.entries[key] = self.entries.pop(key)
+				return True
+		return False
+
+	def record(self, ctx, t1, t2):
+		h1, k1, _ = alpha_key(t1)
+		h2, k2, _ = alpha_key(t2)
+		key = ctx.generation, h1, h2
+		self.entries.pop(key, None)
+		self.entries[key] = k1, k2
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+class ProofCache:
+	"""ProofCache
+
+	A bounded LRU table of the types of proofs, i.e. of terms whose types live in Prop, along with the non-proofs seen.
+	Entries are keyed by context generation, the term's alpha_key hash, and the hashes of the types that the context gives the term's free variables.
+	A single cache is shared by a Context and every copy made of it.
+	"""
+	def __init__(self, max_entries=4096):
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict()
+		self.hits = self.misses = 0
+
+	def make_key(self, ctx, t):
+		"""make_key(ctx, t) -> (table key, alpha key), or None if t's type may yet change"""
+		h, key, free = alpha_key(t)
+		local_types = []
+		for var in free:
+			if not isinstance(var, Var):
+				return None
+			if var in ctx.typings:
+				ty_h, _, ty_free = alpha_key(ctx.typings[var])
+				if any(isinstance(v, Hole) for v in ty_free):
+					return None
+				local_types.append((var.var, ty_h))
+		return (ctx.generation, h, tuple(sorted(local_types))), key
+
+	def lookup(self, ctx, t):
+		"""lookup(ctx, t) -> (found, t's type if it's a proof else None)"""
+		keys = self.make_key(ctx, t)
+		if keys is None:
+			# Terms mentioning metavariables are never treated as proofs.
+			return True, None
+		entry = self.entries.pop(keys[0], None)
+		if entry is None or entry[0] != keys[1]:
+			self.misses += 1
+			return False, None
+		self.hits += 1
+		self.entries[keys[0]] = entry
+		return True, entry[1]
+
+	def record(self, ctx, t, ty):
+		keys = self.make_key(ctx, t)
+		if keys is None:
+			return
+		self.entries.pop(keys[0], None)
+		self.entries[keys[0]] = keys[1], ty
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
 class Context:
 	class WithHandler:
 		def __init__(self, this):
@@ -42,8 +156,16 @@ class Context:
 	def __init__(self):
 		self.typings = {}
 		self.definitions = {}
+		self.heights = {}
+		self.definition_types = {}
+		self.thunks = {}
+		self.opaque = set()
 		self.inductives = {}
 		self.depth = 0
+		self.generation = next(context_generations)
+		self.conversion_cache = ConversionCache()
+		self.proof_cache = ProofCache()
+		self.metas = MetaContext()
 
 	def __repr__(self):
 		return "<ctx: %s %s>" % (self.typings, self.definitions)
@@ -52,8 +174,16 @@ class Context:
 		new_ctx = Context()
 		new_ctx.typings = self.typings.copy()
 		new_ctx.definitions = self.definitions.copy()
+		new_ctx.heights = self.heights.copy()
+		new_ctx.definition_types = self.definition_types.copy()
+		new_ctx.thunks = self.thunks.copy()
+		new_ctx.opaque = self.opaque.copy()
 		new_ctx.inductives = self.inductives.copy()
 		new_ctx.depth = self.depth
+		new_ctx.generation = self.generation
+		new_ctx.conversion_cache = self.conversion_cache
+		new_ctx.proof_cache = self.proof_cache
+		new_ctx.metas = self.metas
 		return new_ctx
 
 	def prefix(self):
@@ -70,6 +200,12 @@ class Context:
 		assert isinstance(var, Var)
 		return var in self.definitions
 
+	def unfoldable(self, var):
+		return var in self.definitions and var not in self.opaque
+
+	def binds(self, var):
+		return var in self.typings or var in self.definitions
+
 	def lookup_ty(self, var):
 		assert isinstance(var, Var)
 		return self.typings[var]
@@ -78,6 +214,23 @@ class Context:
 		assert isinstance(var, Var)
 		return self.definitions[var]
 
+	def height(self, var):
+		"""height(var) -> length of the longest chain of definitions that var's definition depends on, or -1 if var isn't defined
+
+		Heights are computed on first use and then remembered, so definitions bound just to be normalized never pay for them.
+		"""
+		if not self.unfoldable(var):
+			return -1
+		if var not in self.heights:
+			# Provisionally zero, in case a redefinition mentions the definition it replaces.
+			self.heights[var] = 0
+			self.heights[var] = 1 + max([-1] + [
+				self.height(dep)
+				for dep in alpha_key(self.definitions[var])[2]
+				if isinstance(dep, Var) and dep != var
+			])
+		return self.heights[var]
+
 	def extend_ty(self, var, ty, in_place=False):
 		assert isinstance(var, Var)
 		assert isinstance(ty, Term)
@@ -86,15 +239,44 @@ class Context:
 		ctx.typings[var] = ty
 		return ctx
 
-	def extend_def(self, var, term, in_place=False):
+	def extend_def(self, var, term, in_place=False, ty=None):
+		"""extend_def(var, term, in_place=False, ty=None) -> ctx with var defined as term
+
+		If ty is given it must be term's type, and is remembered so that uses of var needn't re-infer it.
+		"""
 		assert isinstance(var, Var)
 		assert isinstance(term, Term)
 		assert var not in self.typings
 		ctx = self if in_place else self.copy()
 		ctx.definitions[var] = term
+		ctx.heights.pop(var, None)
+		ctx.thunks.pop(var, None)
+		ctx.opaque.discard(var)
+		if ty is None:
+			ctx.definition_types.pop(var, None)
+		else:
+			ctx.definition_types[var] = ty
+		ctx.generation = next(context_generations)
 		return ctx
 
-class Parameters:
+	def set_opaque(self, var, opaque):
+		"""set_opaque(var, opaque)
+
+		Makes the definition of var opaque (or transparent again), in place.
+		An opaque definition keeps its type, which is inferred once here, but its body is never unfolded, neither during checking nor evaluation.
+		"""
+		assert self.contains_def(var), "Not a definition: %r" % (var,)
+		if opaque:
+			if var not in self.definition_types:
+				self.definition_types[var] = self.lookup_def(var).infer(self)
+			self.opaque.add(var)
+		else:
+			self.opaque.discard(var)
+		# Which terms are convertible has changed, so both cached conversions and heights are stale.
+		self.heights = {}
+		self.generation = next(context_generations)
+
+class Parameters(HashableMixin):
 	def __init__(self, names, types):
 		assert len(names) == len(types)
 		assert all(isinstance(name, str) for name in names)
@@ -102,6 +284,9 @@ class Parameters:
 		self.names = names
 		self.types = types
 
+	def key(self):
+		return tuple(self.names), tuple(self.types)
+
 	def __len__(self):
 		assert len(self.names) == len(self.types)
 		return len(self.names)
@@ -149,6 +334,7 @@ class Inductive:
 		self.name = name
 		self.parameters = parameters
 		self.arity = arity
+		self.arity_names, self.arity_types = extract_product_spine(arity)
 		self.constructors = collections.OrderedDict()
 
 		# Check the arity is appropriately a product ending in a sort.
@@ -172,12 +358,20 @@ class Inductive:
 		# XXX: Here's the really weird rule about how parameters wrap every constructor with products.
 		# I think this is right? It's really hard to find a description online that's clear.
 		ty = self.parameters.wrap_with_products(base_ty)
-		self.constructors[con_name] = Inductive.Constructor(ty, base_ty)
+		constructor = self.constructors[con_name] = Inductive.Constructor(ty, base_ty)
 
 		# The constructor is required to be nested products, ending in the inductive itself, with parameters and arity saturated.
 		tail = get_product_tail(base_ty)
 		ind, tail_args = extract_app_spine(tail)
 		assert ind == Var(self.name), "Inductive constructors must be a product, with the current inductive as the tail. %r != %s" % (ind, self.name)
+		assert len(tail_args) == len(self.parameters) + len(self.arity_types), "Inductive constructors must saturate the inductive's parameters and arity."
+
+		# Precompute the constructor's signature, so matches needn't take its type apart each time.
+		# Like constructor applications and patterns, the argument telescope starts with the inductive's parameters.
+		constructor.position = len(self.constructors) - 1
+		constructor.arg_names, constructor.arg_types = extract_product_spine(ty)
+		constructor.arity = len(constructor.arg_types)
+		constructor.index_args = tail_args[len(self.parameters):]
 
 		# Make sure ty is well-typed assuming all the parameters are well-typed.
 		constructor_ctx = self.parameters.extend_context_with_typing(ctx)
@@ -199,6 +393,9 @@ class Inductive:
 # ===== Define term ilks =====
 
 class Term(HashableMixin):
+	# Terms are allocated at every level of subst and normalize, so every ilk declares __slots__ to avoid carrying a __dict__.
+	__slots__ = ("_alpha_key",)
+
 	def key(self): raise NotImplementedError
 	def __repr__(self): raise NotImplementedError
 	def normalize(self, ctx, strategy): raise NotImplementedError
@@ -216,11 +413,16 @@ class Term(HashableMixin):
 	def check(self, ctx, ty):
 		print ctx.prefix() + "Check:", self, ":", ty
 		with ctx.depth_scope():
-			inferred_type = self.infer(ctx)
-			if not compare_terms(ctx, inferred_type, ty):
-				raise TypeCheckFailure("Failure to match: %r != %r" % (inferred_type, ty))
+			# A failed check mustn't leave behind metavariable solutions made along the way.
+			ctx.metas.attempt(lambda: self.do_check(ctx, ty))
 		print ctx.prefix() + "Pass!"
 
+	def do_check(self, ctx, ty):
+		# By default we infer our type and compare, but ilks that can push ty inward override this.
+		inferred_type = self.infer(ctx)
+		if not compare_terms(ctx, inferred_type, ty):
+			raise TypeCheckFailure("Failure to match: %r != %r" % (ctx.metas.zonk(inferred_type), ctx.metas.zonk(ty)))
+
 	def subst(self, x, y):
 		return self
 
@@ -228,6 +430,8 @@ class Term(HashableMixin):
 		return False
 
 class Annotation(Term):
+	__slots__ = "term", "ty"
+
 	def __init__(self, term, ty):
 		self.term = term
 		self.ty = ty
@@ -254,12 +458,21 @@ class Annotation(Term):
 		self.term.check(ctx, self.ty), "Type annotation failed!"
 		return self.ty
 
+	def do_check(self, ctx, ty):
+		# Compare our annotation first, so a mismatch is found without checking our term.
+		self.ty.check(ctx, SortType(0))
+		if not compare_terms(ctx, self.ty, ty):
+			raise TypeCheckFailure("Failure to match: %r != %r" % (self.ty, ty))
+		self.term.check(ctx, self.ty)
+
 	def free_vars(self):
 		# XXX: Should the annotation be included in free variables?
 		# Hmm...
 		return self.term.free_vars() | self.ty.free_vars()
 
 class SortType(Term):
+	__slots__ = "universe_index",
+
 	def __init__(self, universe_index):
 		assert isinstance(universe_index, int)
 		assert universe_index >= 0
@@ -284,7 +497,7 @@ class SortType(Term):
 	def check(self, ctx, ty):
 		# XXX: Implement universe cumulativity here!
 		# FIXME: Currently this code forces Type{i} : Type{i}
-		if ty != self:
+		if ty != self and not (ctx.metas.is_unsolved(ty) and ctx.metas.unify(ctx, ty, self)):
 			raise TypeCheckFailure("Failure to match: %r != %r" % (ty, self))
 
 	def free_vars(self):
@@ -294,6 +507,8 @@ class SortType(Term):
 		return True
 
 class SortProp(SortType):
+	__slots__ = ()
+
 	def __init__(self):
 		pass
 
@@ -308,6 +523,8 @@ class SortProp(SortType):
 		return SortType(0)
 
 class Var(Term):
+	__slots__ = "var",
+
 	def __init__(self, var):
 		assert isinstance(var, str)
 		self.var = var
@@ -324,7 +541,9 @@ class Var(Term):
 		return self
 
 	def normalize(self, ctx, strategy):
-		if ctx.contains_def(self):
+		if ctx.unfoldable(self):
+			if self in ctx.thunks:
+				return ctx.thunks[self].force(strategy)
 			return ctx.lookup_def(self).normalize(ctx, strategy)
 		# XXX: This should be an error!
 		# We need a separate atom type soon.
@@ -333,6 +552,8 @@ class Var(Term):
 	def do_infer(self, ctx):
 		if ctx.contains_ty(self):
 			return ctx.lookup_ty(self)
+		elif self in ctx.definition_types:
+			return ctx.definition_types[self]
 		elif ctx.contains_def(self):
 			return ctx.lookup_def(self).infer(ctx)
 		print "BAD CONTEXT:", ctx
@@ -342,6 +563,8 @@ class Var(Term):
 		return set([self])
 
 class DependentProduct(Term):
+	__slots__ = "var", "var_ty", "result_ty"
+
 	def __init__(self, var, var_ty, result_ty):
 		assert isinstance(var, Var)
 		assert isinstance(var_ty, Term)
@@ -360,12 +583,15 @@ class DependentProduct(Term):
 		return "(\xe2\x88\x80 %s : %s . %s)" % (self.var, self.var_ty, self.result_ty)
 
 	def subst(self, x, y):
-		# For now don't handle this case, as it means we were probably inappropriately alpha-sensitive.
-		assert x != self.var
+		if x == self.var:
+			# As in Abstraction.subst, our binder shadows x in our result, but not in our variable's type.
+			# This comes up whenever non-dependent arrows, which all bind "!", are nested.
+			return DependentProduct(self.var, self.var_ty.subst(x, y), self.result_ty)
+		var, result_ty = rename_apart(self.var, self.result_ty, y)
 		return DependentProduct(
-			self.var,
+			var,
 			self.var_ty.subst(x, y),
-			self.result_ty.subst(x, y),
+			result_ty.subst(x, y),
 		)
 
 	def normalize(self, ctx, strategy):
@@ -391,6 +617,8 @@ class DependentProduct(Term):
 		return self.var_ty.free_vars() | (self.result_ty.free_vars() - set([self.var]))
 
 class Abstraction(Term):
+	__slots__ = "var", "var_ty", "result"
+
 	def __init__(self, var, var_ty, result):
 		assert isinstance(var, Var)
 		self.var = var
@@ -416,10 +644,11 @@ class Abstraction(Term):
 				self.var_ty.subst(x, y),
 				self.result,
 			)
+		var, result = rename_apart(self.var, self.result, y)
 		return Abstraction(
-			self.var,
+			var,
 			self.var_ty.subst(x, y),
-			self.result.subst(x, y),
+			result.subst(x, y),
 		)
 
 	def normalize(self, ctx, strategy):
@@ -436,10 +665,28 @@ class Abstraction(Term):
 		# XXX: Do I need to abstract over self.var somehow?
 		return DependentProduct(self.var, self.var_ty, u)
 
+	def do_check(self, ctx, ty):
+		# Check our result against the codomain directly, rather than inferring a whole product to compare.
+		product = ty.normalize(ctx, EvalStrategy.WHNF)
+		if ctx.metas.is_unsolved(product):
+			product = coerce_to_product(ctx, product)
+		if not isinstance(product, DependentProduct):
+			raise TypeCheckFailure("Failure to match: function %r against non-product %r" % (self, ty))
+		var_sort = self.var_ty.infer(ctx)
+		assert var_sort.is_sort()
+		if not compare_terms(ctx, self.var_ty, product.var_ty):
+			raise TypeCheckFailure("Failure to match: %r != %r" % (self.var_ty, product.var_ty))
+		result_ty = product.result_ty
+		if product.var != self.var and product.var in resolved_free_vars(result_ty):
+			result_ty = result_ty.subst(product.var, self.var)
+		self.result.check(ctx.extend_ty(self.var, self.var_ty), result_ty)
+
 	def free_vars(self):
 		return self.var_ty.free_vars() | (self.result.free_vars() - set([self.var]))
 
 class Application(Term):
+	__slots__ = "fn", "arg"
+
 	def __init__(self, fn, arg):
 		self.fn = fn
 		self.arg = arg
@@ -458,6 +705,11 @@ class Application(Term):
 		arg = self.arg
 		if strategy == EvalStrategy.CBV:
 			arg = arg.normalize(ctx, strategy)
+		# A fixpoint only reduces once it has been applied to its structural argument, so collect the whole spine.
+		if isinstance(fn, (Application, Fix)):
+			head, args = extract_app_spine(fn)
+			if isinstance(head, Fix):
+				return head.reduce_application(ctx, strategy, args + [arg])
 		# If our function isn't concrete, then early out.
 		if not isinstance(fn, Abstraction):
 			return Application(fn, arg)
@@ -474,7 +726,81 @@ class Application(Term):
 	def free_vars(self):
 		return self.fn.free_vars() | self.arg.free_vars()
 
+class Thunk(object):
+	"""Thunk
+
+	The value of a let-bound variable, normalized the first time it's needed and then shared by every use.
+	"""
+	__slots__ = "ctx", "term", "strategy"
+
+	def __init__(self, ctx, term):
+		self.ctx = ctx
+		self.term = term
+		self.strategy = None
+
+	def force(self, strategy):
+		# A CBV normal form is also in weak head normal form, but not vice versa.
+		if self.strategy is None or (strategy == EvalStrategy.CBV and self.strategy != EvalStrategy.CBV):
+			self.term = self.term.normalize(self.ctx, strategy)
+			self.strategy = strategy
+		return self.term
+
+class Let(Term):
+	__slots__ = "var", "ty", "value", "body"
+
+	def __init__(self, var, ty, value, body):
+		assert isinstance(var, Var)
+		self.var = var
+		self.ty = ty
+		self.value = value
+		self.body = body
+
+	def key(self):
+		return self.var, self.ty, self.value, self.body
+
+	def __repr__(self):
+		return "(let %s : %s := %s in %s)" % (self.var, self.ty, self.value, self.body)
+
+	def subst(self, x, y):
+		if x == self.var:
+			return Let(self.var, self.ty.subst(x, y), self.value.subst(x, y), self.body)
+		var, body = rename_apart(self.var, self.body, y)
+		return Let(var, self.ty.subst(x, y), self.value.subst(x, y), body.subst(x, y))
+
+	def bind(self, ctx):
+		"""bind(ctx) -> (ctx extended with var defined as our value, which is typed and evaluated at most once, var, our body in terms of var)
+
+		var is a fresh variable, as binders in our body may shadow our own, and those may only be typed, not defined, in ctx.
+		"""
+		var = fresh_var(self.var)
+		body_ctx = ctx.extend_def(var, self.value, ty=self.ty)
+		body_ctx.thunks[var] = Thunk(ctx, self.value)
+		return body_ctx, var, self.body.subst(self.var, var)
+
+	def normalize(self, ctx, strategy):
+		body_ctx, var, body = self.bind(ctx)
+		body = body.normalize(body_ctx, strategy)
+		# Our variable can survive normalization (e.g. under a binder), so put the shared value back in its place.
+		return body.subst(var, body_ctx.thunks[var].term)
+
+	def do_infer(self, ctx):
+		assert self.ty.infer(ctx).is_sort()
+		self.value.check(ctx, self.ty)
+		body_ctx, var, body = self.bind(ctx)
+		return body.infer(body_ctx).subst(var, self.value)
+
+	def do_check(self, ctx, ty):
+		assert self.ty.infer(ctx).is_sort()
+		self.value.check(ctx, self.ty)
+		body_ctx, _, body = self.bind(ctx)
+		body.check(body_ctx, ty)
+
+	def free_vars(self):
+		return self.ty.free_vars() | self.value.free_vars() | (self.body.free_vars() - set([self.var]))
+
 class InductiveRef(Term):
+	__slots__ = "name",
+
 	def __init__(self, name):
 		self.name = name
 
@@ -497,6 +823,8 @@ class InductiveRef(Term):
 		return ctx.inductives[self.name]
 
 class ConstructorRef(Term):
+	__slots__ = "name", "con_name"
+
 	def __init__(self, name, con_name):
 		self.name = name
 		self.con_name = con_name
@@ -523,6 +851,8 @@ class ConstructorRef(Term):
 		return self.get_inductive(ctx).constructors[self.con_name]
 
 class Fix(Term):
+	__slots__ = "recursive_var", "params", "ty", "body", "_structural_index", "_unfolded_body"
+
 	def __init__(self, recursive_name, params, ty, body):
 		assert isinstance(recursive_name, str)
 		assert isinstance(params, Parameters)
@@ -532,6 +862,8 @@ class Fix(Term):
 		self.params = params
 		self.ty = ty
 		self.body = body
+		self._structural_index = None
+		self._unfolded_body = None
 
 	def key(self):
 		return self.recursive_var, self.params, self.ty, self.body
@@ -544,17 +876,103 @@ class Fix(Term):
 			self.body,
 		)
 
+	def subst(self, x, y):
+		free = resolved_free_vars(y)
+		if self.recursive_var in free or any(Var(name) in free for name in self.params.names):
+			return self.renamed_apart(free).subst(x, y)
+		# The parameters are bound sequentially, so x is shadowed from the first parameter with its name onwards.
+		shadowed = False
+		types = []
+		for name, ty in zip(self.params.names, self.params.types):
+			types.append(ty if shadowed else ty.subst(x, y))
+			shadowed = shadowed or Var(name) == x
+		return Fix(
+			self.recursive_var.var,
+			Parameters(self.params.names, types),
+			self.ty if shadowed else self.ty.subst(x, y),
+			self.body if shadowed or x == self.recursive_var else self.body.subst(x, y),
+		)
+
+	def renamed_apart(self, free):
+		"""renamed_apart(free) -> an alpha-equivalent Fix, none of whose binders are in free"""
+		names, types = list(self.params.names), list(self.params.types)
+		ty, body = self.ty, self.body
+		recursive_var = self.recursive_var
+		# If a parameter shadows our recursive name then the body can't mention the latter, and renaming the parameter suffices.
+		if recursive_var in free and recursive_var.var not in names:
+			recursive_var = fresh_var(recursive_var)
+			body = body.subst(self.recursive_var, recursive_var)
+		for i, name in enumerate(names):
+			var = Var(name)
+			if var not in free:
+				continue
+			new_var = fresh_var(var)
+			names[i] = new_var.var
+			# The parameter is in scope until a later one with the same name shadows it.
+			shadowed = False
+			for j in xrange(i + 1, len(names)):
+				types[j] = types[j].subst(var, new_var)
+				if names[j] == name:
+					shadowed = True
+					break
+			if not shadowed:
+				ty, body = ty.subst(var, new_var), body.subst(var, new_var)
+		return Fix(recursive_var.var, Parameters(names, types), ty, body)
+
 	def normalize(self, ctx, strategy):
-		# XXX: FIXME: The current strategy here is to eta-expand one level of the Fix.
-		# This is a *terrible* solution, and probably just doesn't work.
-		# An unapplied Fix should be considered to in normal form already.
-		# We need to extend Application to know about a Fix.
-		function_term = self.params.wrap_with_abstractions(self.body)
-		# XXX: The following extend_def is totally bogus and does nothing.
-#		# Give a reference to the recursive Fix to our child.
-#		ctx = ctx.extend_def(self.recursive_var, self)
-		print "Function term:", function_term
-		return function_term.normalize(ctx, strategy)
+		# An unapplied Fix is already in normal form; Application.normalize calls reduce_application once we have arguments.
+		return self
+
+	def structural_index(self, ctx):
+		"""structural_index(ctx) -> index of the parameter we recurse on, or None
+
+		For now this is the first parameter whose type is an inductive.
+		"""
+		if self._structural_index is None:
+			index = -1
+			for i, ty in enumerate(self.params.types):
+				head, _ = extract_app_spine(ty.normalize(ctx, EvalStrategy.WHNF))
+				if isinstance(head, InductiveRef):
+					index = i
+					break
+				if ctx.metas.is_unsolved(head):
+					# We can't tell yet, so don't cache anything.
+					return None
+			self._structural_index = index
+		return self._structural_index if self._structural_index != -1 else None
+
+	def unfolded_body(self):
+		"""unfolded_body() -> our body with the recursive name bound to this Fix
+
+		This is cached, so every recursive call reuses the same unfolding.
+		"""
+		if self._unfolded_body is None:
+			self._unfolded_body = self.body.subst(self.recursive_var, self)
+		return self._unfolded_body
+
+	def reduce_application(self, ctx, strategy, args):
+		# We only unfold once our structural argument is constructor-headed.
+		# Unfolding on anything else (e.g. a variable) would let normalization of the recursive calls diverge.
+		index = self.structural_index(ctx)
+		if index is None or len(args) < len(self.params):
+			return form_app_spine(self, args)
+		args = list(args)
+		if strategy == EvalStrategy.WHNF:
+			args[index] = args[index].normalize(ctx, EvalStrategy.WHNF)
+		head, _ = extract_app_spine(args[index])
+		if not isinstance(head, ConstructorRef):
+			return form_app_spine(self, args)
+		# We substitute the arguments one parameter at a time, which is only simultaneous substitution if no parameter is free in an argument (or in us).
+		fix = self
+		free = set(resolved_free_vars(self))
+		for arg in args[:len(self.params)]:
+			free |= resolved_free_vars(arg)
+		if any(Var(name) in free for name in self.params.names):
+			fix = self.renamed_apart(free)
+		instantiation = fix.unfolded_body()
+		for name, arg in zip(fix.params.names, args):
+			instantiation = instantiation.subst(Var(name), arg)
+		return form_app_spine(instantiation, args[len(self.params):]).normalize(ctx, strategy)
 
 	def overall_type(self, ctx):
 		return self.params.wrap_with_products(self.ty)
@@ -564,20 +982,40 @@ class Fix(Term):
 		# This makes the theory trivially unsound via: (fix f (x : False) : False := f x) : False
 
 		overall_type = self.overall_type(ctx)
+		self.check_body(ctx, overall_type)
+		return overall_type
+
+	def do_check(self, ctx, ty):
+		# Comparing first lets ty solve any metavariables in our parameter and return types before our body is checked.
+		overall_type = self.overall_type(ctx)
+		if not compare_terms(ctx, overall_type, ty):
+			raise TypeCheckFailure("Failure to match: %r != %r" % (overall_type, ty))
+		self.check_body(ctx, overall_type)
 
+	def check_body(self, ctx, overall_type):
 		# Build our recursive context in which self.recursive_var is assumed to have the right fixed type.
 		ctx = ctx.extend_ty(self.recursive_var, overall_type)
 		# Also assume our arguments have the given types.
 		ctx = self.params.extend_context_with_typing(ctx)
 		# Now check that our result has the right type.
 		self.body.check(ctx, self.ty)
-		return overall_type
 
 	def free_vars(self):
-		return set()
+		free = set()
+		bound = set()
+		for name, ty in zip(self.params.names, self.params.types):
+			free |= ty.free_vars() - bound
+			bound.add(Var(name))
+		free |= self.ty.free_vars() - bound
+		free |= self.body.free_vars() - bound - set([self.recursive_var])
+		return free
 
 class Match(Term):
+	__slots__ = "matchand", "as_term", "in_term", "return_term", "arms"
+
 	class Arm(HashableMixin):
+		__slots__ = "pattern", "result", "pattern_head", "pattern_args"
+
 		def __init__(self, pattern, result):
 			self.pattern = pattern
 			self.result = result
@@ -592,11 +1030,16 @@ class Match(Term):
 			return "| %s => %s" % (self.pattern, self.result)
 
 		def subst(self, x, y):
-			# XXX: Subtle binding here to double-check!
-			result = self.result if x in self.pattern_args else self.result.subst(x, y)
+			if x in self.pattern_args:
+				return self
+			# Rename any pattern variables that would capture y's free variables.
+			args, result = [], self.result
+			for var in self.pattern_args:
+				var, result = rename_apart(var, result, y)
+				args.append(var)
 			return Match.Arm(
-				self.pattern.subst(x, y),
-				result,
+				form_app_spine(self.pattern_head, args),
+				result.subst(x, y),
 			)
 
 		def free_vars(self):
@@ -680,6 +1123,16 @@ class Match(Term):
 		# First check that (matchand : I pars t_1 ... t_p)
 		# Where pars are our parameters, and the t_1 through t_p saturate the arity.
 		matchand_ty = self.matchand.infer(ctx).normalize(ctx, EvalStrategy.WHNF)
+		if ctx.metas.is_unsolved(matchand_ty) and self.arms:
+			# The matchand's type isn't known yet, but our patterns tell us which inductive it must be.
+			arm_inductive = self.arms[0].pattern_head.get_inductive(ctx)
+			guess = form_app_spine(InductiveRef(arm_inductive.name), [
+				ctx.metas.fresh(ty)
+				for ty in arm_inductive.parameters.types + arm_inductive.arity_types
+			])
+			if not ctx.metas.unify(ctx, matchand_ty, guess):
+				raise TypeCheckFailure("Failure to match: matchand of type %r against %r" % (ctx.metas.zonk(matchand_ty), guess))
+			matchand_ty = guess
 		matchand_ty_head, matchand_ty_args = extract_app_spine(matchand_ty)
 		assert isinstance(matchand_ty_head, InductiveRef), "Bad matchand ilk: %s" % (matchand_ty,)
 
@@ -694,7 +1147,7 @@ class Match(Term):
 		# Therefore, we want our as_term_type to be the inductive (I) applied first to the pars from matchand_ty_args, then to the arity-saturating part of in_term.
 		pars = matchand_ty_args[:len(inductive.parameters)]
 		_, in_args = extract_app_spine(self.in_term)
-		_, arity_tys = extract_product_spine(inductive.arity)
+		arity_tys = inductive.arity_types
 		assert len(in_args) == len(arity_tys), "Extended match's in term must have exactly the same number of arguments as number of arguments in the inductive's arity (not its parameters!)"
 
 		as_term_type = form_app_spine(form_app_spine(matchand_ty_head, pars), in_args)
@@ -704,7 +1157,12 @@ class Match(Term):
 		return_ctx = ctx.copy()
 		for arg, ty in zip(in_args, arity_tys):
 			return_ctx.extend_ty(arg, ty, in_place=True)
-		return_ctx.extend_ty(self.as_term, as_term_type, in_place=True)
+		# Without an as clause our as_term is an anonymous Hole, and binds nothing.
+		if isinstance(self.as_term, Var):
+			return_ctx.extend_ty(self.as_term, as_term_type, in_place=True)
+		# An elided return clause is a metavariable, which mustn't be solved with anything mentioning an arm's pattern variables.
+		if ctx.metas.is_unsolved(return_ty):
+			ctx.metas.restrict_scope(return_ty, return_ctx)
 
 		# This corresponds to the second line in the typing rule on the bottom of page 7 of this document:
 		#     https://hal.inria.fr/hal-01094195/document (Introduction to the Calculus of Inductive constructions)
@@ -714,38 +1172,23 @@ class Match(Term):
 		assert return_sort.is_sort()
 
 		# Check that we have exactly one arm for each constructor of our inductive.
-		arm_constructors = collections.Counter(arm.pattern_head for arm in self.arms)
-		all_constructors = collections.Counter(
-			ConstructorRef(inductive.name, cons_name)
-			for cons_name in inductive.constructors
-		)
-		assert arm_constructors == all_constructors, "Arms of match failed to be exhaustive and mutually-exclusive! %r != %r" % (arm_constructors, all_constructors)
+		positions = set()
+		for arm in self.arms:
+			assert arm.pattern_head.name == inductive.name and arm.pattern_head.con_name in inductive.constructors, "Arm for a constructor of the wrong inductive: %r" % (arm.pattern_head,)
+			positions.add(inductive.constructors[arm.pattern_head.con_name].position)
+		assert len(positions) == len(self.arms) == len(inductive.constructors), "Arms of match failed to be exhaustive and mutually-exclusive! %r" % ([arm.pattern_head for arm in self.arms],)
 
 		# Check that every arm is well-typed.
 		for arm in self.arms:
-			constructor = arm.pattern_head.get_constructor(ctx)
-			# We now pull out the constructor args (x_1 : A_1) ... (x_n : A_n) (from the above paper).
-			_, cons_args_tys = extract_product_spine(constructor.base_ty)
-
+			constructor = inductive.constructors[arm.pattern_head.con_name]
+			assert len(arm.pattern_args) == constructor.arity, "Pattern %r must bind exactly %i arguments." % (arm.pattern, constructor.arity)
+			# The constructor args (x_1 : A_1) ... (x_n : A_n) from the above paper.
 			arm_ctx = ctx.copy()
-			for arg, ty in zip(arm.pattern_args, cons_args_tys):
+			for arg, ty in zip(arm.pattern_args, constructor.arg_types):
 				arm_ctx.extend_ty(arg, ty, in_place=True)
 
-			# Next we pull out the arity-saturating (the u_1 ... u_p from the paper) of the arguments to the inductive at end of the constructor's type.
-			tail = get_product_tail(constructor.base_ty)
-			tail_head, tail_args = extract_app_spine(tail)
-
-			# NB: These next two asserts should technically be redundant with the well-formedness checks that occur when the inductive was formed.
-			# TODO: Evaluate if I want to do these at all.
-
-			# We normalize in this check because tail_head will be a var in general.
-			assert tail_head.normalize(ctx, EvalStrategy.WHNF) == InductiveRef(inductive.name), "Bad constructor head: %r (BUG BUG BUG: This should have been ruled out when the inductive was formed.)" % (tail,)
-
-			# The number of tail args should be exactly len(params) + len(arity).
-			assert len(tail_args) == len(inductive.parameters) + len(arity_tys), "Malformed tail in inductive constructor! (BUG BUG BUG: This should have been caught when the inductive was formed.)"
-
-			# These are the u_1 ... u_p from the paper.
-			arity_saturating_ind_app_args = tail_args[-len(arity_tys):]
+			# These are the u_1 ... u_p from the paper: the arity-saturating arguments to the inductive at the end of the constructor's type.
+			arity_saturating_ind_app_args = constructor.index_args
 			assert len(in_args) == len(arity_saturating_ind_app_args) == len(arity_tys)
 
 			demanded_type = return_ty
@@ -761,7 +1204,7 @@ class Match(Term):
 			arm.result.check(arm_ctx, demanded_type)
 
 		# Extract t_1 ... t_p from the paper.
-		matchand_arity_saturating = matchand_ty_args[-len(arity_tys):]
+		matchand_arity_saturating = matchand_ty_args[len(inductive.parameters):]
 
 		# Compute the final (dependent) return type.
 		final_return_type = return_ty
@@ -775,6 +1218,15 @@ class Match(Term):
 
 		return final_return_type
 
+	def do_check(self, ctx, ty):
+		# An elided return clause of a non-dependent match is just ty, so solve it up front, and every arm is checked against ty directly.
+		_, in_args = extract_app_spine(self.in_term)
+		if ctx.metas.is_unsolved(self.return_term) and not isinstance(self.as_term, Var) and not in_args:
+			ctx.metas.unify(ctx, self.return_term, ty)
+		inferred_type = self.do_infer(ctx)
+		if not compare_terms(ctx, inferred_type, ty):
+			raise TypeCheckFailure("Failure to match: %r != %r" % (ctx.metas.zonk(inferred_type), ctx.metas.zonk(ty)))
+
 	def free_vars(self):
 		# XXX: This is probably wrong, as the as_term and in_term parts form bindings that should eliminate free variables from the return_term part.
 		root_free = reduce(lambda x, y: x | y, [
@@ -783,10 +1235,12 @@ class Match(Term):
 		])
 		arms_free = set()
 		for arm in self.arms:
-			arms_free |= arm.free_vars(ctx)
+			arms_free |= arm.free_vars()
 		return root_free | arms_free
 
 class Axiom(Term):
+	__slots__ = "ty",
+
 	def __init__(self, ty):
 		self.ty = ty
 
@@ -811,9 +1265,14 @@ class Axiom(Term):
 		return set()
 
 class Hole(Term):
-	def __init__(self, identifier=""):
+	__slots__ = "identifier", "metas"
+
+	def __init__(self, identifier="", metas=None):
 		assert isinstance(identifier, str)
+		assert metas is None or isinstance(metas, MetaContext)
 		self.identifier = identifier
+		# Holes made by MetaContext.fresh are metavariables, and keep a reference to their store so that they can be resolved without a Context.
+		self.metas = metas
 
 	def key(self):
 		return self.identifier
@@ -821,17 +1280,44 @@ class Hole(Term):
 	def __repr__(self):
 		return "_%s" % (self.identifier,)
 
+	def is_meta(self):
+		return self.metas is not None
+
+	def resolve(self):
+		"""resolve() -> our solution if we're a solved metavariable, otherwise self"""
+		if self.metas is None:
+			return self
+		return self.metas.resolve(self)
+
 	def subst(self, x, y):
-		return self
+		solution = self.resolve()
+		if solution is self:
+			return self
+		return solution.subst(x, y)
 
 	def normalize(self, ctx, strategy):
-		return self
+		solution = self.resolve()
+		if solution is self:
+			return self
+		return solution.normalize(ctx, strategy)
 
 	def do_infer(self, ctx):
-		raise NotImplementedError("Type inference cannot currently handle holes.")
+		if not self.is_meta():
+			raise NotImplementedError("Type inference cannot handle anonymous holes.")
+		solution = self.resolve()
+		if solution is not self:
+			return solution.infer(ctx)
+		return self.metas.types[self.identifier]
 
 	def free_vars(self):
-		return set()
+		solution = self.resolve()
+		if solution is self:
+			return set()
+		return solution.free_vars()
+
+	def is_sort(self):
+		solution = self.resolve()
+		return solution is not self and solution.is_sort()
 
 # ===== End term ilks =====
 
@@ -862,15 +1348,139 @@ def get_product_tail(term):
 		term = term.result_ty
 	return term
 
+def unfold_head(ctx, head, args):
+	"""unfold_head(ctx, head, args) -> the application of head's definition to args, beta reduced along the spine"""
+	fn = ctx.lookup_def(head)
+	args = list(args)
+	while args and isinstance(fn, Abstraction):
+		fn = fn.result.subst(fn.var, args.pop(0))
+	return form_app_spine(fn, args)
+
+def delta_compare(ctx, t1, t2):
+	"""delta_compare(ctx, t1, t2) -> (True, False or None, t1', t2')
+
+	Tries to decide whether t1 and t2 are convertible by unfolding definitions at their heads one at a time, the higher definition first, and by comparing applications with the same head argument-wise before unfolding them.
+	Applications of the same inductive, constructor or undefined variable are convertible exactly when their arguments are.
+	Otherwise gives up with None once neither head is a definition, returning the reducts reached so far, which are convertible with t1 and t2.
+	"""
+	while True:
+		if t1 is t2 or alpha_key(t1)[1] == alpha_key(t2)[1]:
+			return True, t1, t2
+		head1, args1 = extract_app_spine(t1)
+		head2, args2 = extract_app_spine(t2)
+		height1 = ctx.height(head1) if isinstance(head1, Var) else -1
+		height2 = ctx.height(head2) if isinstance(head2, Var) else -1
+		if head1 == head2 and len(args1) == len(args2) and isinstance(head1, (Var, InductiveRef, ConstructorRef)):
+			if all(compare_terms(ctx, a1, a2) for a1, a2 in zip(args1, args2)):
+				return True, t1, t2
+			if height1 < 0:
+				return False, t1, t2
+		if height1 < 0 and height2 < 0:
+			return None, t1, t2
+		if height1 >= height2:
+			t1 = unfold_head(ctx, head1, args1)
+		if height2 >= height1:
+			t2 = unfold_head(ctx, head2, args2)
+
+def synthesize_type(ctx, t):
+	"""synthesize_type(ctx, t) -> t's type, or None
+
+	Reads off the type of a term that's assumed to be well typed, without checking anything (or printing a trace, as infer does).
+	Gives up with None on matches, and on products whose sort isn't Prop, because working out their universe isn't cheap.
+	"""
+	if isinstance(t, Var):
+		if ctx.contains_ty(t):
+			return ctx.lookup_ty(t)
+		elif t in ctx.definition_types:
+			return ctx.definition_types[t]
+		elif ctx.contains_def(t):
+			return synthesize_type(ctx, ctx.lookup_def(t))
+		return None
+	elif isinstance(t, (SortType, InductiveRef, ConstructorRef)):
+		return t.do_infer(ctx)
+	elif isinstance(t, (Annotation, Axiom)):
+		return t.ty
+	elif isinstance(t, Fix):
+		return t.overall_type(ctx)
+	elif isinstance(t, Hole) and t.is_meta():
+		solution = t.resolve()
+		if solution is not t:
+			return synthesize_type(ctx, solution)
+		return t.metas.types[t.identifier]
+	elif isinstance(t, Application):
+		fn_ty = synthesize_type(ctx, t.fn)
+		if fn_ty is None:
+			return None
+		fn_ty = fn_ty.normalize(ctx, EvalStrategy.WHNF)
+		if not isinstance(fn_ty, DependentProduct):
+			return None
+		return fn_ty.result_ty.subst(fn_ty.var, t.arg)
+	elif isinstance(t, Let):
+		body_ctx, var, body = t.bind(ctx)
+		body_ty = synthesize_type(body_ctx, body)
+		return None if body_ty is None else body_ty.subst(var, t.value)
+	elif isinstance(t, (DependentProduct, Abstraction)):
+		# We don't bother with binders that shadow definitions.
+		if ctx.contains_def(t.var):
+			return None
+		body_ctx = ctx.extend_ty(t.var, t.var_ty)
+		if isinstance(t, Abstraction):
+			body_ty = synthesize_type(body_ctx, t.result)
+			return None if body_ty is None else DependentProduct(t.var, t.var_ty, body_ty)
+		# Prop is impredicative, so a product is a proposition exactly when its codomain is.
+		sort = synthesize_type(body_ctx, t.result_ty)
+		if sort is not None and isinstance(sort.normalize(body_ctx, EvalStrategy.WHNF), SortProp):
+			return sort
+	return None
+
+def proof_type(ctx, t):
+	"""proof_type(ctx, t) -> t's type if that's a proposition (so t is a proof), else None"""
+	found, ty = ctx.proof_cache.lookup(ctx, t)
+	if not found:
+		ty = synthesize_type(ctx, t)
+		if ty is not None:
+			sort = synthesize_type(ctx, ty)
+			if sort is None or not isinstance(sort.normalize(ctx, EvalStrategy.WHNF), SortProp):
+				ty = None
+		ctx.proof_cache.record(ctx, t, ty)
+	return ty
+
 def compare_terms(ctx, t1, t2):
-	t1 = t1.normalize(ctx, EvalStrategy.CBV)
-	t2 = t2.normalize(ctx, EvalStrategy.CBV)
+	if t1 is t2 or ctx.conversion_cache.lookup(ctx, t1, t2):
+		return True
+	# Proof irrelevance: any two proofs of the same proposition are convertible.
+	ty1 = proof_type(ctx, t1)
+	if ty1 is not None:
+		ty2 = proof_type(ctx, t2)
+		if ty2 is not None and compare_terms(ctx, ty1, ty2):
+			return True
+	r1, r2 = t1, t2
+	if not (ctx.metas.mentions_metas(t1) or ctx.metas.mentions_metas(t2)):
+		result, r1, r2 = delta_compare(ctx, t1, t2)
+		if result is not None:
+			return result
+	n1 = r1.normalize(ctx, EvalStrategy.CBV)
+	n2 = n1 if r2 is r1 else r2.normalize(ctx, EvalStrategy.CBV)
 	# TODO: Maybe implement the additional rules that Spartan TT does?
-	return alpha_equivalent(ctx, t1, t2)
+	if ctx.metas.mentions_metas(n1) or ctx.metas.mentions_metas(n2):
+		return ctx.metas.unify(ctx, n1, n2)
+	if not may_be_alpha_equivalent(ctx, n1, n2):
+		return False
+	result = alpha_equivalent(ctx, n1, n2)
+	# Only remember the result if every free variable is bound, for the same reason as in may_be_alpha_equivalent.
+	if result and all(ctx.binds(var) for t in (t1, t2) for var in alpha_key(t)[2]):
+		ctx.conversion_cache.record(ctx, t1, t2)
+	return result
 
 def coerce_to_product(ctx, term):
 	assert isinstance(term, Term)
 	term = term.normalize(ctx, EvalStrategy.WHNF)
+	if ctx.metas.is_unsolved(term):
+		# We only know that we're a function, so refine to a non-dependent product of fresh metavariables.
+		product = DependentProduct(Var("!"), ctx.metas.fresh_type(), ctx.metas.fresh_type())
+		if not ctx.metas.unify(ctx, term, product):
+			raise TypeCheckFailure("Failure to match: %r against a product" % (ctx.metas.zonk(term),))
+		return product
 	assert isinstance(term, DependentProduct), "Bad product: %r" % (term,)
 	return term
 
@@ -931,10 +1541,62 @@ class AlphaCanonicalizer:
 				self.canonicalize(t.fn),
 				self.canonicalize(t.arg),
 			)
+		elif isinstance(t, Let):
+			ty = self.canonicalize(t.ty)
+			value = self.canonicalize(t.value)
+			saved_subs = self.subs.copy()
+			self.subs.pop(t.var, None)
+			try:
+				return Let(self.canonicalize(t.var), ty, value, self.canonicalize(t.body))
+			finally:
+				self.subs = saved_subs
+		elif isinstance(t, Fix):
+			# Scoped as in AlphaKeyBuilder: each parameter is bound in the later parameter types, the result type and the body, and the recursive variable only in the body.
+			saved_subs = self.subs.copy()
+			try:
+				recursive_var = self.new_var()
+				names, types = [], []
+				for name, ty in zip(t.params.names, t.params.types):
+					types.append(self.canonicalize(ty))
+					self.subs[Var(name)] = self.new_var()
+					names.append(self.subs[Var(name)].var)
+				ty = self.canonicalize(t.ty)
+				if t.recursive_var.var not in t.params.names:
+					self.subs[t.recursive_var] = recursive_var
+				return Fix(recursive_var.var, Parameters(names, types), ty, self.canonicalize(t.body))
+			finally:
+				self.subs = saved_subs
+		elif isinstance(t, Match):
+			matchand = self.canonicalize(t.matchand)
+			in_head, in_args = extract_app_spine(t.in_term)
+			in_head = self.canonicalize(in_head)
+			return_binders = in_args + [t.as_term] if isinstance(t.as_term, Var) else in_args
+			saved_subs = self.subs.copy()
+			try:
+				as_term = t.as_term if isinstance(t.as_term, Var) else self.canonicalize(t.as_term)
+				for var in return_binders:
+					self.subs[var] = self.new_var()
+				in_term = form_app_spine(in_head, [self.subs[var] for var in in_args])
+				if isinstance(as_term, Var):
+					as_term = self.subs[as_term]
+				return_term = self.canonicalize(t.return_term)
+			finally:
+				self.subs = saved_subs
+			return Match(matchand, as_term, in_term, return_term, [self.canonicalize_arm(arm) for arm in t.arms])
 		elif isinstance(t, (SortType, SortProp, InductiveRef, ConstructorRef, Axiom, Hole)):
 			return t
 		raise NotImplementedError("Unhandled: %r" % (t,))
 
+	def canonicalize_arm(self, arm):
+		head = self.canonicalize(arm.pattern_head)
+		saved_subs = self.subs.copy()
+		try:
+			for var in arm.pattern_args:
+				self.subs[var] = self.new_var()
+			return Match.Arm(form_app_spine(head, [self.subs[var] for var in arm.pattern_args]), self.canonicalize(arm.result))
+		finally:
+			self.subs = saved_subs
+
 def alpha_canonicalize(ctx, term):
 	canonicalizer = AlphaCanonicalizer(ctx)
 	return canonicalizer.canonicalize(term)
@@ -942,6 +1604,338 @@ def alpha_canonicalize(ctx, term):
 def alpha_equivalent(ctx, t1, t2):
 	return alpha_canonicalize(ctx, t1) == alpha_canonicalize(ctx, t2)
 
+class AlphaKeyBuilder:
+	"""AlphaKeyBuilder
+
+	Builds a hashable key for a term that is invariant under renaming of bound variables.
+	Variables bound within the term are replaced by their de Bruijn level, and free variables are kept by name.
+	"""
+	def __init__(self):
+		self.levels = {}
+		self.depth = 0
+		self.free = set()
+
+	def bind(self, variables, build):
+		saved = self.levels.copy()
+		for var in variables:
+			self.levels[var] = self.depth
+			self.depth += 1
+		try:
+			return build()
+		finally:
+			self.depth -= len(variables)
+			self.levels = saved
+
+	def build(self, t):
+		assert isinstance(t, Term), "Bad object: %r (%r)" % (t, type(t))
+		if isinstance(t, Var):
+			if t in self.levels:
+				return "bound", self.levels[t]
+			self.free.add(t)
+			return "var", t.var
+		elif isinstance(t, SortProp):
+			return "prop",
+		elif isinstance(t, SortType):
+			return "type", t.universe_index
+		elif isinstance(t, Annotation):
+			return "annotation", self.build(t.term), self.build(t.ty)
+		elif isinstance(t, DependentProduct):
+			return "product", self.build(t.var_ty), self.bind([t.var], lambda: self.build(t.result_ty))
+		elif isinstance(t, Abstraction):
+			return "abstraction", self.build(t.var_ty), self.bind([t.var], lambda: self.build(t.result))
+		elif isinstance(t, Application):
+			return "application", self.build(t.fn), self.build(t.arg)
+		elif isinstance(t, Let):
+			return "let", self.build(t.ty), self.build(t.value), self.bind([t.var], lambda: self.build(t.body))
+		elif isinstance(t, InductiveRef):
+			return "inductive", t.name
+		elif isinstance(t, ConstructorRef):
+			return "constructor", t.name, t.con_name
+		elif isinstance(t, Fix):
+			params = [Var(name) for name in t.params.names]
+			param_tys = tuple(
+				self.bind(params[:i], lambda: self.build(ty))
+				for i, ty in enumerate(t.params.types)
+			)
+			return "fix", param_tys, self.bind(params, lambda: self.build(t.ty)), self.bind([t.recursive_var] + params, lambda: self.build(t.body))
+		elif isinstance(t, Match):
+			in_head, in_args = extract_app_spine(t.in_term)
+			return_binders = in_args + [t.as_term] if isinstance(t.as_term, Var) else in_args
+			return (
+				"match",
+				self.build(t.matchand),
+				self.build(in_head),
+				len(in_args),
+				self.bind(return_binders, lambda: self.build(t.return_term)),
+				tuple(
+					(self.build(arm.pattern_head), len(arm.pattern_args), self.bind(arm.pattern_args, lambda: self.build(arm.result)))
+					for arm in t.arms
+				),
+			)
+		elif isinstance(t, Hole) and t.is_meta():
+			# Metavariables count as free, so that terms mentioning them are never rejected or cached.
+			# Solutions aren't looked through, because the key is cached and the metavariable may be solved later.
+			self.free.add(t)
+			return "meta", t.identifier
+		elif isinstance(t, (Axiom, Hole)):
+			# AlphaCanonicalizer leaves these untouched, so they are compared exactly.
+			return t.__class__.__name__, t
+		raise NotImplementedError("Unhandled: %r" % (t,))
+
+def alpha_key(term):
+	"""alpha_key(term) -> (hash, key, free variables and metavariables)
+
+	The result is cached on the term, so repeated lookups on the same term are O(1).
+	"""
+	cached = getattr(term, "_alpha_key", None)
+	if cached is None:
+		builder = AlphaKeyBuilder()
+		key = builder.build(term)
+		cached = term._alpha_key = hash(key), key, frozenset(builder.free)
+	return cached
+
+def may_be_alpha_equivalent(ctx, t1, t2):
+	"""may_be_alpha_equivalent(ctx, t1, t2) -> False only if t1 and t2 are certainly not alpha_equivalent
+
+	AlphaCanonicalizer renames variables that aren't bound in ctx, so differing alpha keys only prove inequivalence when all free variables are bound.
+	"""
+	h1, k1, free1 = alpha_key(t1)
+	h2, k2, free2 = alpha_key(t2)
+	if h1 == h2 and k1 == k2:
+		return True
+	return not all(ctx.binds(var) for var in free1 | free2)
+
+class MetaContext:
+	"""MetaContext
+
+	Stores the metavariables made for Holes during elaboration, along with their types and solutions.
+	Solutions are never substituted into terms eagerly: a solved metavariable resolves to its solution when it's looked at, and zonk() produces the fully substituted term once it's needed.
+	A single MetaContext is shared by a Context and every copy made of it.
+	"""
+	def __init__(self):
+		self.solutions = {}
+		self.types = {}
+		self.scopes = {}
+		self.trail = None
+		self.counter = itertools.count(1)
+
+	def fresh(self, ty):
+		assert isinstance(ty, Term)
+		identifier = str(next(self.counter))
+		self.solutions[identifier] = None
+		self.types[identifier] = ty
+		return Hole(identifier, self)
+
+	def fresh_type(self):
+		"""fresh_type() -> a metavariable standing for a type"""
+		# XXX: Universe polymorphism missing! Every sort infers to Type0 for now anyway.
+		return self.fresh(SortType(0))
+
+	def restrict_scope(self, meta, ctx):
+		"""restrict_scope(meta, ctx)
+
+		Demand that the free variables of meta's solution are all bound in ctx.
+		Metavariables made while parsing don't know their scope, so by default their solutions aren't scope checked.
+		"""
+		self.scopes[meta.identifier] = ctx
+
+	def is_unsolved(self, term):
+		return isinstance(term, Hole) and term.metas is self and self.solutions[term.identifier] is None
+
+	def assign(self, identifier, value):
+		if self.trail is not None:
+			self.trail.append((identifier, self.solutions[identifier]))
+		self.solutions[identifier] = value
+
+	def resolve(self, term):
+		"""resolve(term) -> the end of the chain of solutions starting at term"""
+		path = []
+		while isinstance(term, Hole) and term.metas is self:
+			solution = self.solutions[term.identifier]
+			if solution is None:
+				break
+			path.append(term.identifier)
+			term = solution
+		# Path compression: point every metavariable we passed through straight at the end of the chain.
+		for identifier in path[:-1]:
+			self.assign(identifier, term)
+		return term
+
+	def mentions_metas(self, term):
+		return any(isinstance(var, Hole) for var in alpha_key(term)[2])
+
+	def unify(self, ctx, t1, t2):
+		"""unify(ctx, t1, t2) -> True if t1 and t2 have been made convertible by solving metavariables
+
+		If unification fails then every solution it made is rolled back.
+		"""
+		return self.attempt(lambda: Unifier(ctx, self).unify(t1, t2))
+
+	def attempt(self, f):
+		"""attempt(f) -> f()
+
+		Every solution made while f runs is rolled back if it raises or returns False.
+		"""
+		outer_trail, self.trail = self.trail, []
+		success = False
+		try:
+			result = f()
+			success = result is not False
+			return result
+		finally:
+			trail, self.trail = self.trail, outer_trail
+			if not success:
+				for identifier, old_value in reversed(trail):
+					self.solutions[identifier] = old_value
+			elif outer_trail is not None:
+				outer_trail.extend(trail)
+
+	def zonk(self, term):
+		"""zonk(term) -> term with every solved metavariable substituted away
+
+		Subterms without any solved metavariables are returned as is.
+		"""
+		assert isinstance(term, Term), "Bad object: %r (%r)" % (term, type(term))
+		if isinstance(term, Hole):
+			solution = term.resolve()
+			return term if solution is term else self.zonk(solution)
+		elif isinstance(term, Annotation):
+			return self.rebuild(term, Annotation, term.term, term.ty)
+		elif isinstance(term, DependentProduct):
+			return self.rebuild(term, DependentProduct, term.var, term.var_ty, term.result_ty)
+		elif isinstance(term, Abstraction):
+			return self.rebuild(term, Abstraction, term.var, term.var_ty, term.result)
+		elif isinstance(term, Application):
+			return self.rebuild(term, Application, term.fn, term.arg)
+		elif isinstance(term, Let):
+			return self.rebuild(term, Let, term.var, term.ty, term.value, term.body)
+		elif isinstance(term, Fix):
+			types = [self.zonk(ty) for ty in term.params.types]
+			ty, body = self.zonk(term.ty), self.zonk(term.body)
+			if all(a is b for a, b in zip(types + [ty, body], term.params.types + [term.ty, term.body])):
+				return term
+			return Fix(term.recursive_var.var, Parameters(term.params.names, types), ty, body)
+		elif isinstance(term, Match):
+			parts = [self.zonk(t) for t in (term.matchand, term.as_term, term.in_term, term.return_term)]
+			arms = [Match.Arm(arm.pattern, self.zonk(arm.result)) for arm in term.arms]
+			return Match(*(parts + [arms]))
+		return term
+
+	def rebuild(self, term, kind, *children):
+		zonked = [child if isinstance(child, Var) else self.zonk(child) for child in children]
+		if all(a is b for a, b in zip(zonked, children)):
+			return term
+		return kind(*zonked)
+
+class Unifier:
+	"""Unifier
+
+	Solves metavariables so as to make two terms convertible, using pattern unification.
+	A metavariable applied to distinct variables (?m x1 ... xn) against a term t is solved by ?m := (fun x1 ... xn => t), provided that t mentions no other variables bound during the unification, and doesn't mention ?m.
+	Bound variables on each side are tracked by their binder depth, so alpha-renamings are handled without substituting.
+	"""
+	def __init__(self, ctx, metas):
+		self.ctx = ctx
+		self.metas = metas
+		self.levels = ({}, {})
+		self.names = []
+
+	def unify(self, t1, t2):
+		t1 = self.normalize(t1)
+		t2 = self.normalize(t2)
+		if isinstance(t1, Hole) and isinstance(t2, Hole) and t1.identifier == t2.identifier and t1.metas is t2.metas:
+			return True
+		for side, (t, other) in enumerate(((t1, t2), (t2, t1))):
+			head, spine = extract_app_spine(t)
+			if self.metas.is_unsolved(head) and self.is_pattern_spine(side, spine):
+				return self.solve(side, head, spine, other)
+		if t1.__class__ is not t2.__class__:
+			return False
+		if isinstance(t1, Var):
+			l1, l2 = self.levels[0].get(t1), self.levels[1].get(t2)
+			if l1 is not None or l2 is not None:
+				return l1 == l2
+			return t1 == t2
+		elif isinstance(t1, Annotation):
+			return self.unify(t1.term, t2.term) and self.unify(t1.ty, t2.ty)
+		elif isinstance(t1, DependentProduct):
+			return self.unify(t1.var_ty, t2.var_ty) and self.under_binder(t1.var, t2.var, t1.result_ty, t2.result_ty)
+		elif isinstance(t1, Abstraction):
+			return self.unify(t1.var_ty, t2.var_ty) and self.under_binder(t1.var, t2.var, t1.result, t2.result)
+		elif isinstance(t1, Application):
+			return self.unify(t1.fn, t2.fn) and self.unify(t1.arg, t2.arg)
+		# Everything else (sorts, references, axioms, Fix, Match) must be alpha-equivalent.
+		return self.rigid_key(0, t1) == self.rigid_key(1, t2)
+
+	def rigid_key(self, side, t):
+		"""rigid_key(side, t) -> the alpha key of t, with the variables bound on our side during unification named by their level"""
+		t = self.metas.zonk(t)
+		for var in alpha_key(t)[2]:
+			level = self.levels[side].get(var)
+			if level is not None:
+				t = t.subst(var, Var("!%i" % level))
+		return alpha_key(t)[1]
+
+	def normalize(self, t):
+		# A variable bound during the unification mustn't be unfolded to a global definition with the same name.
+		if isinstance(t, Var) and (t in self.levels[0] or t in self.levels[1]):
+			return t
+		return t.normalize(self.ctx, EvalStrategy.WHNF)
+
+	def under_binder(self, var1, var2, body1, body2):
+		saved = self.levels[0].get(var1), self.levels[1].get(var2), self.ctx
+		level = len(self.names)
+		self.levels[0][var1] = self.levels[1][var2] = level
+		self.names.append((var1, var2))
+		# Unbind any global definitions our binders shadow, so normalization doesn't unfold them.
+		if var1 in self.ctx.definitions or var2 in self.ctx.definitions:
+			self.ctx = self.ctx.copy()
+			self.ctx.definitions.pop(var1, None)
+			self.ctx.definitions.pop(var2, None)
+			self.ctx.generation = next(context_generations)
+		try:
+			return self.unify(body1, body2)
+		finally:
+			self.names.pop()
+			for side, var, old in ((0, var1, saved[0]), (1, var2, saved[1])):
+				if old is None:
+					del self.levels[side][var]
+				else:
+					self.levels[side][var] = old
+			self.ctx = saved[2]
+
+	def is_pattern_spine(self, side, spine):
+		return all(isinstance(arg, Var) for arg in spine) and len(set(spine)) == len(spine)
+
+	def solve(self, side, meta, spine, other):
+		other = self.metas.zonk(other)
+		_, _, free = alpha_key(other)
+		if meta in free:
+			# Occurs check.
+			return False
+		# Variables the other side bound during unification may only appear via our spine, under our names for them.
+		scope = self.metas.scopes.get(meta.identifier)
+		for var in free:
+			if not isinstance(var, Var):
+				continue
+			level = self.levels[1 - side].get(var)
+			if level is not None:
+				ours = self.names[level][side]
+				if ours not in spine:
+					return False
+				if ours != var:
+					other = other.subst(var, ours)
+			elif var not in spine and scope is not None and not scope.binds(var):
+				return False
+		for var in reversed(spine):
+			if var not in self.levels[side] and self.ctx.contains_ty(var):
+				var_ty = self.ctx.lookup_ty(var)
+			else:
+				var_ty = self.metas.fresh_type()
+			other = Abstraction(var, var_ty, other)
+		self.metas.assign(meta.identifier, other)
+		return True
+
 """
 class HoleFiller:
 	def fill(self, t):
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+"""
+erasure.py
+
+Erases kernel terms to a small untyped IR of lambdas, constructors and cases, and evaluates that IR.
+Sorts, types and proofs carry no computational content, so they all erase to BOX, and annotations vanish.
+The evaluator works with environments and closures rather than substitution, and never re-checks or re-normalizes types.
+
+Erasure trusts that terms are well typed, reading types off with easy.synthesize_type.
+Whenever a term can't be erased or evaluated (e.g. it mentions an axiom, an opaque definition or an unsolved hole), or its value can't be read back into a kernel term exactly (e.g. it's a function), Stuck is raised, and the caller should normalize in the kernel instead.
+"""
+
+import easy
+
+class Stuck(Exception):
+	pass
+
+class Box(object):
+	__slots__ = ()
+
+	def __repr__(self):
+		return "\xe2\x96\xa1"
+
+BOX = Box()
+
+class Var(object):
+	__slots__ = "name",
+
+	def __init__(self, name):
+		self.name = name
+
+	def __repr__(self):
+		return self.name
+
+class Global(object):
+	__slots__ = "name",
+
+	def __init__(self, name):
+		self.name = name
+
+	def __repr__(self):
+		return "@" + self.name
+
+class Lam(object):
+	__slots__ = "var", "body"
+
+	def __init__(self, var, body):
+		self.var = var
+		self.body = body
+
+	def __repr__(self):
+		return "(\xce\xbb %s . %r)" % (self.var, self.body)
+
+class App(object):
+	__slots__ = "fn", "arg"
+
+	def __init__(self, fn, arg):
+		self.fn = fn
+		self.arg = arg
+
+	def __repr__(self):
+		return "(%r %r)" % (self.fn, self.arg)
+
+class Con(object):
+	__slots__ = "name", "con_name", "arity"
+
+	def __init__(self, name, con_name, arity):
+		self.name = name
+		self.con_name = con_name
+		self.arity = arity
+
+	def __repr__(self):
+		return "%s::%s" % (self.name, self.con_name)
+
+class Case(object):
+	__slots__ = "name", "scrutinee", "arms"
+
+	def __init__(self, name, scrutinee, arms):
+		"""Case(inductive name, scrutinee, {con_name: ([pattern variable names], body)})"""
+		self.name = name
+		self.scrutinee = scrutinee
+		self.arms = arms
+
+	def __repr__(self):
+		return "case %r of %s" % (self.scrutinee, " | ".join(
+			"%s %s => %r" % (con_name, " ".join(names), body)
+			for con_name, (names, body) in self.arms.iteritems()
+		))
+
+class Fix(object):
+	__slots__ = "recursive_name", "params", "structural_index", "body"
+
+	def __init__(self, recursive_name, params, structural_index, body):
+		self.recursive_name = recursive_name
+		self.params = params
+		self.structural_index = structural_index
+		self.body = body
+
+	def __repr__(self):
+		return "fix %s %s := %r" % (self.recursive_name, " ".join(self.params), self.body)
+
+class Let(object):
+	__slots__ = "var", "value", "body"
+
+	def __init__(self, var, value, body):
+		self.var = var
+		self.value = value
+		self.body = body
+
+	def __repr__(self):
+		return "(let %s := %r in %r)" % (self.var, self.value, self.body)
+
+def bind_ty(ctx, var, ty):
+	"""bind_ty(ctx, var, ty) -> ctx with var typed as ty, shadowing any definition of var"""
+	if ctx.contains_def(var):
+		ctx = ctx.copy()
+		ctx.definitions.pop(var)
+		ctx.generation = next(easy.context_generations)
+	return ctx.extend_ty(var, ty)
+
+def is_erasable(ctx, t):
+	"""is_erasable(ctx, t) -> True if t is a type, a type family or a proof"""
+	if isinstance(t, (easy.SortType, easy.DependentProduct, easy.InductiveRef)):
+		return True
+	head, _ = easy.extract_app_spine(t)
+	if isinstance(head, easy.InductiveRef):
+		return True
+	# Constructor applications are the bulk of literal data, so decide them without synthesizing a type.
+	if isinstance(head, easy.ConstructorRef):
+		return isinstance(head.get_inductive(ctx).inductive_sort, easy.SortProp)
+	ty = easy.synthesize_type(ctx, t)
+	if ty is None:
+		return False
+	tail = easy.get_product_tail(ty.normalize(ctx, easy.EvalStrategy.WHNF))
+	if tail.is_sort():
+		return True
+	# We already have t's type, so rather than going through easy.proof_type (whose cache key costs time linear in t) just check its sort.
+	sort = easy.synthesize_type(ctx, ty)
+	return sort is not None and isinstance(sort.normalize(ctx, easy.EvalStrategy.WHNF), easy.SortProp)
+
+class Eraser:
+	def __init__(self, ctx):
+		self.ctx = ctx
+		self.globals = {}
+
+	def erase_global(self, var):
+		if var not in self.globals:
+			self.globals[var] = self.erase(self.ctx, self.ctx.lookup_def(var), frozenset())
+		return self.globals[var]
+
+	def erase(self, ctx, t, bound):
+		"""erase(ctx, t, bound) -> IR for t, where bound is the set of variables bound by enclosing IR binders"""
+		if isinstance(t, easy.Hole):
+			solution = t.resolve()
+			if solution is t:
+				raise Stuck("Unsolved hole: %r" % (t,))
+			return self.erase(ctx, solution, bound)
+		if isinstance(t, easy.Annotation):
+			return self.erase(ctx, t.term, bound)
+		if is_erasable(ctx, t):
+			return BOX
+		if isinstance(t, easy.Var):
+			if t in bound:
+				return Var(t.var)
+			if ctx.unfoldable(t):
+				self.erase_global(t)
+				return Global(t.var)
+			raise Stuck("Can't compute with: %r" % (t,))
+		elif isinstance(t, easy.Abstraction):
+			return Lam(t.var.var, self.erase(bind_ty(ctx, t.var, t.var_ty), t.result, bound | set([t.var])))
+		elif isinstance(t, easy.Application):
+			return App(self.erase(ctx, t.fn, bound), self.erase(ctx, t.arg, bound))
+		elif isinstance(t, easy.Let):
+			body_ctx, var, body = t.bind(ctx)
+			return Let(var.var, self.erase(ctx, t.value, bound), self.erase(body_ctx, body, bound | set([var])))
+		elif isinstance(t, easy.ConstructorRef):
+			return Con(t.name, t.con_name, t.get_constructor(ctx).arity)
+		elif isinstance(t, easy.Fix):
+			index = t.structural_index(ctx)
+			if index is None:
+				raise Stuck("Fix without a structural argument: %r" % (t,))
+			body_ctx = bind_ty(ctx, t.recursive_var, t.overall_type(ctx))
+			params = [easy.Var(name) for name in t.params.names]
+			for var, ty in zip(params, t.params.types):
+				body_ctx = bind_ty(body_ctx, var, ty)
+			body = self.erase(body_ctx, t.body, bound | set(params + [t.recursive_var]))
+			return Fix(t.recursive_var.var, t.params.names, index, body)
+		elif isinstance(t, easy.Match):
+			arms = {}
+			name = None
+			for arm in t.arms:
+				name = arm.pattern_head.name
+				constructor = arm.pattern_head.get_constructor(ctx)
+				arm_ctx = ctx
+				for var, ty in zip(arm.pattern_args, constructor.arg_types):
+					arm_ctx = bind_ty(arm_ctx, var, ty)
+				arms[arm.pattern_head.con_name] = (
+					[var.var for var in arm.pattern_args],
+					self.erase(arm_ctx, arm.result, bound | set(arm.pattern_args)),
+				)
+			return Case(name, self.erase(ctx, t.matchand, bound), arms)
+		raise Stuck("Can't erase: %r" % (t,))
+
+class Closure(object):
+	__slots__ = "var", "body", "env"
+
+	def __init__(self, var, body, env):
+		self.var = var
+		self.body = body
+		self.env = env
+
+class ConValue(object):
+	__slots__ = "con", "args"
+
+	def __init__(self, con, args):
+		self.con = con
+		self.args = args
+
+class FixValue(object):
+	__slots__ = "fix", "env", "args"
+
+	def __init__(self, fix, env, args):
+		self.fix = fix
+		self.env = env
+		self.args = args
+
+class Evaluator:
+	"""Evaluator
+
+	Call-by-value evaluation of erased IR, with each global definition evaluated at most once.
+	"""
+	def __init__(self, eraser):
+		self.eraser = eraser
+		self.globals = {}
+
+	def evaluate(self, ir, env):
+		if ir is BOX:
+			return BOX
+		elif isinstance(ir, Var):
+			return env[ir.name]
+		elif isinstance(ir, Global):
+			if ir.name not in self.globals:
+				self.globals[ir.name] = self.evaluate(self.eraser.globals[easy.Var(ir.name)], {})
+			return self.globals[ir.name]
+		elif isinstance(ir, Lam):
+			return Closure(ir.var, ir.body, env)
+		elif isinstance(ir, App):
+			fn = self.evaluate(ir.fn, env)
+			return self.apply(fn, self.evaluate(ir.arg, env))
+		elif isinstance(ir, Let):
+			env = env.copy()
+			env[ir.var] = self.evaluate(ir.value, env)
+			return self.evaluate(ir.body, env)
+		elif isinstance(ir, Con):
+			return ConValue(ir, ())
+		elif isinstance(ir, Fix):
+			return FixValue(ir, env, ())
+		elif isinstance(ir, Case):
+			value = self.evaluate(ir.scrutinee, env)
+			if not isinstance(value, ConValue) or len(value.args) != value.con.arity:
+				raise Stuck("Case on a non-constructor.")
+			names, body = ir.arms[value.con.con_name]
+			env = env.copy()
+			env.update(zip(names, value.args))
+			return self.evaluate(body, env)
+		raise Stuck("Can't evaluate: %r" % (ir,))
+
+	def apply(self, fn, arg):
+		if fn is BOX:
+			# Erased type families are applied to erased arguments.
+			return BOX
+		elif isinstance(fn, Closure):
+			env = fn.env.copy()
+			env[fn.var] = arg
+			return self.evaluate(fn.body, env)
+		elif isinstance(fn, ConValue):
+			return ConValue(fn.con, fn.args + (arg,))
+		elif isinstance(fn, FixValue):
+			args = fn.args + (arg,)
+			fix = fn.fix
+			if len(args) < len(fix.params):
+				return FixValue(fix, fn.env, args)
+			# Like the kernel, we only unfold on a constructor, so this can't diverge.
+			if not isinstance(args[fix.structural_index], ConValue):
+				raise Stuck("Fix applied to a non-constructor.")
+			env = fn.env.copy()
+			env[fix.recursive_name] = FixValue(fix, fn.env, ())
+			env.update(zip(fix.params, args))
+			result = self.evaluate(fix.body, env)
+			for extra in args[len(fix.params):]:
+				result = self.apply(result, extra)
+			return result
+		raise Stuck("Can't apply: %r" % (fn,))
+
+	def read_back(self, value, ty):
+		"""read_back(value, ty) -> the kernel term for a fully applied constructor value of type ty"""
+		return read_back(self.eraser.ctx, value, ty, unpack_con_value)
+
+def unpack_con_value(value):
+	if not isinstance(value, ConValue) or len(value.args) != value.con.arity:
+		raise Stuck("Only constructor values can be read back.")
+	return value.con.name, value.con.con_name, value.args
+
+def read_back(ctx, value, ty, unpack):
+	"""read_back(ctx, value, ty, unpack) -> the kernel term for value, a constructor tree of type ty
+
+	unpack(value) -> (inductive name, constructor name, arguments), or raises Stuck if value isn't a constructor value.
+	The inductive's parameters were erased, so they're read off ty instead, which may be None if the inductive has none.
+	"""
+	name, con_name, args = unpack(value)
+	inductive = ctx.inductives[name]
+	parameters = []
+	if len(inductive.parameters):
+		head, ty_args = easy.extract_app_spine(ty.normalize(ctx, easy.EvalStrategy.WHNF)) if ty is not None else (None, [])
+		if not isinstance(head, easy.InductiveRef) or head.name != name:
+			raise Stuck("Can't read back the parameters of: %s::%s" % (name, con_name))
+		# Normalize them as the kernel would have.
+		parameters = [t.normalize(ctx, easy.EvalStrategy.CBV) for t in ty_args[:len(inductive.parameters)]]
+	# Instantiate the constructor's type one argument at a time, so each argument is read back at its own type.
+	con_ty = inductive.constructors[con_name].ty
+	terms = []
+	for i, arg in enumerate(args):
+		if i < len(parameters):
+			term = parameters[i]
+		elif arg is BOX:
+			raise Stuck("Erased arguments can't be read back.")
+		else:
+			term = read_back(ctx, arg, con_ty.var_ty, unpack)
+		terms.append(term)
+		result_ty = con_ty.result_ty
+		if con_ty.var in easy.alpha_key(result_ty)[2]:
+			result_ty = result_ty.subst(con_ty.var, term)
+		con_ty = result_ty
+	return easy.form_app_spine(easy.ConstructorRef(name, con_name), terms)
+
+def evaluate(ctx, term):
+	"""evaluate(ctx, term) -> the value of term, as a kernel term
+
+	Raises Stuck if term can't be evaluated after erasure, or if its value isn't a constructor tree.
+	"""
+	eraser = Eraser(ctx)
+	ir = eraser.erase(ctx, term, frozenset())
+	evaluator = Evaluator(eraser)
+	return evaluator.read_back(evaluator.evaluate(ir, {}), easy.synthesize_type(ctx, term))
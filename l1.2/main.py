@@ -1,10 +1,20 @@
 #!/usr/bin/python
 
-import sys, argparse, functools
+import os, sys, time, json, select, argparse, functools, traceback, multiprocessing
 import parsing
 import easy
+import printing
+import erasure
+import native
 
 vernacular_table = {}
+# Keyword arguments for printing.print_term, set from the command line.
+print_options = {}
+# How Eval computes: "native" (compiled to Python), "erased" (interpreting erased terms), or "kernel".
+eval_backend = "native"
+# Every failed Check vernacular, as (term, type, error message).
+check_failures = []
+
 def vernacular_handler(vernacular_name):
 	def dec(f):
 		vernacular_table[vernacular_name] = f
@@ -62,7 +72,7 @@ def vernac_infer(context, vernac):
 	term, = vernac.children
 	term = parsing.unpack_term_ast(context, term)
 	ty = term.infer(context)
-	print "Infer: %s : %s" % (term, ty)
+	print "Infer: %s : %s" % (context.metas.zonk(term), context.metas.zonk(ty))
 
 @vernacular_handler("vernac_check")
 def vernac_check(context, vernac):
@@ -70,28 +80,207 @@ def vernac_check(context, vernac):
 	try:
 		print "Vernac check:", term, ":", ty
 		term.check(context, ty)
-		print "Successful type check: %s : %s" % (term, ty)
+		print "Successful type check: %s : %s" % (context.metas.zonk(term), context.metas.zonk(ty))
 	except easy.TypeCheckFailure, e:
 		print "Type check failure:", e
+		check_failures.append((str(term), str(ty), str(e)))
 
 @vernacular_handler("vernac_eval")
 def vernac_eval(context, vernac):
 	term, = vernac.children
 	term = parsing.unpack_term_ast(context, term)
-	term = term.normalize(context, easy.EvalStrategy.CBV)
-	print "Eval:", term
+	# Run the erased program if we can, which is much faster, but only yields constructor trees.
+	try:
+		if eval_backend == "native":
+			term = native.evaluate(context, term)
+		elif eval_backend == "erased":
+			term = erasure.evaluate(context, term)
+		else:
+			raise erasure.Stuck("Evaluating in the kernel.")
+	except (erasure.Stuck, RuntimeError):
+		# Deep values can exhaust Python's stack in the other backends, which the kernel is given a go at too.
+		try:
+			term = context.metas.zonk(term.normalize(context, easy.EvalStrategy.CBV))
+		except RuntimeError, e:
+			print "Eval failure:", e
+			return
+	# Eval results can be huge, so stream them out rather than building their repr.
+	sys.stdout.write("Eval: ")
+	printing.print_term(term, sys.stdout, **print_options)
+	sys.stdout.write("\n")
+
+@vernacular_handler("vernac_opaque")
+def vernac_opaque(context, vernac):
+	name, = vernac.children
+	context.set_opaque(easy.Var(str(name)), True)
+	print "Opaque:", name
+
+@vernacular_handler("vernac_transparent")
+def vernac_transparent(context, vernac):
+	name, = vernac.children
+	context.set_opaque(easy.Var(str(name)), False)
+	print "Transparent:", name
 
-def interpret(path):
+def interpret(path, context=None):
+	"""interpret(path, context=None) -> context
+
+	Runs every vernacular in the file at path, in context if given (which is extended in place), otherwise in a fresh Context.
+	"""
 	with open(path) as f:
 		code = "".join(
 			line for line in f
 			if not line.strip().startswith("#")
 		)
-	context = easy.Context()
+	if context is None:
+		context = easy.Context()
 	vernacs = parsing.vernac_parser.parse(code)
 	for vernac in vernacs.children:
 		vernacular_table[vernac.data](context, vernac)
+	return context
+
+class BatchChecker:
+	"""BatchChecker
+
+	Checks many files that all start from the same prelude.
+	The prelude is interpreted once, and then a child is forked per file, which inherits the prelude's Context copy-on-write, so the environment is never re-checked or serialized.
+	At most `jobs` children run at once, and each sends back a JSON result over a pipe.
+	"""
+	def __init__(self, prelude_path=None, jobs=None, log_dir=None):
+		self.prelude_path = prelude_path
+		self.jobs = jobs or multiprocessing.cpu_count()
+		self.log_dir = log_dir
+
+	def log_path(self, path):
+		if self.log_dir is None:
+			return os.devnull
+		return os.path.join(self.log_dir, os.path.basename(path) + ".log")
+
+	def run_quietly(self, log_path, f):
+		saved_stdout = sys.stdout
+		with open(log_path, "w") as log:
+			sys.stdout = log
+			try:
+				return f()
+			finally:
+				sys.stdout = saved_stdout
+
+	def check_all(self, paths):
+		"""check_all(paths) -> (prelude seconds, [prelude check failure message], [result dict per path, in order])"""
+		if self.log_dir is not None and not os.path.isdir(self.log_dir):
+			os.makedirs(self.log_dir)
+		start = time.time()
+		context = easy.Context()
+		if self.prelude_path is not None:
+			self.run_quietly(self.log_path(self.prelude_path), lambda: interpret(self.prelude_path, context))
+		prelude_time = time.time() - start
+		# Children inherit check_failures, so empty it, and only report the prelude's failures once.
+		prelude_failures = [message for _, _, message in check_failures]
+		del check_failures[:]
+
+		results = {}
+		running = {}
+		pending = list(paths)
+		while pending or running:
+			while pending and len(running) < self.jobs:
+				path = pending.pop(0)
+				read_fd, write_fd = os.pipe()
+				pid = os.fork()
+				if pid == 0:
+					os.close(read_fd)
+					self.child(context, path, write_fd)
+				os.close(write_fd)
+				running[read_fd] = path, pid, []
+			# Drain every pipe as it fills, since a child blocks writing a result bigger than the pipe's buffer, and only reap a child once its pipe is closed.
+			readable, _, _ = select.select(list(running), [], [])
+			for read_fd in readable:
+				path, pid, chunks = running[read_fd]
+				chunk = os.read(read_fd, 65536)
+				if chunk:
+					chunks.append(chunk)
+					continue
+				os.close(read_fd)
+				del running[read_fd]
+				_, status = os.waitpid(pid, 0)
+				try:
+					results[path] = json.loads("".join(chunks))
+				except ValueError:
+					results[path] = {"path": path, "ok": False, "seconds": None, "error": "Worker died with status %i." % (status,)}
+		return prelude_time, prelude_failures, [results[path] for path in paths]
+
+	def child(self, context, path, write_fd):
+		# Never return into the parent's loop: always leave via os._exit.
+		try:
+			start = time.time()
+			error = None
+			try:
+				self.run_quietly(self.log_path(path), lambda: interpret(path, context))
+			except Exception:
+				error = traceback.format_exc().strip().split("\n")[-1]
+			result = {
+				"path": path,
+				"ok": error is None and not check_failures,
+				"seconds": time.time() - start,
+				"error": error,
+				"check_failures": [message for _, _, message in check_failures],
+			}
+			with os.fdopen(write_fd, "w") as f:
+				json.dump(result, f)
+		finally:
+			os._exit(0)
+
+def print_batch_report(prelude_path, prelude_time, prelude_failures, results):
+	if prelude_path is not None:
+		print "Prelude %s checked once in %.3fs." % (prelude_path, prelude_time)
+	for message in prelude_failures:
+		print "       Type check failure in prelude: %s" % (message,)
+	for result in results:
+		seconds = "%.3fs" % (result["seconds"],) if result["seconds"] is not None else "-"
+		print "%-4s %8s  %s" % ("ok" if result["ok"] else "FAIL", seconds, result["path"])
+		if result["error"]:
+			print "       %s" % (result["error"].encode("utf-8"),)
+		for message in result.get("check_failures", []):
+			print "       Type check failure: %s" % (message.encode("utf-8"),)
+	failures = sum(not result["ok"] for result in results)
+	print "%i files, %i failed, %.3fs total checking time." % (
+		len(results),
+		failures,
+		sum(result["seconds"] or 0 for result in results),
+	)
+	if prelude_failures:
+		print "The prelude had %i type check failures." % (len(prelude_failures),)
 
 if __name__ == "__main__":
-	interpret(sys.argv[1])
+	p = argparse.ArgumentParser()
+	p.add_argument("sources", nargs="+")
+	p.add_argument("--prelude", default=None, help="Check this file once, and then check every source in a forked copy of its context. Implies batch mode.")
+	p.add_argument("--jobs", type=int, default=None, help="Maximum number of files checked at once in batch mode. Defaults to the number of CPUs.")
+	p.add_argument("--log-dir", default=None, help="In batch mode, write each file's output to a log here instead of discarding it.")
+	p.add_argument("--json-report", default=None, help="In batch mode, also write the report as JSON to this path.")
+	p.add_argument("--max-print-depth", type=int, default=None, help="Elide Eval output nested deeper than this.")
+	p.add_argument("--max-print-width", type=int, default=None, help="Cut off Eval output after this many characters.")
+	p.add_argument("--share-subterms", action="store_true", help="Print repeated subterms of Eval output once, as let-bindings.")
+	p.add_argument("--eval-backend", choices=["native", "erased", "kernel"], default="native", help="How Eval computes. Falls back to the kernel whenever the others get stuck.")
+	args = p.parse_args()
+	eval_backend = args.eval_backend
+	print_options.update(
+		max_depth=args.max_print_depth,
+		max_width=args.max_print_width,
+		sharing=args.share_subterms,
+	)
+	if len(args.sources) == 1 and args.prelude is None:
+		interpret(args.sources[0])
+	else:
+		checker = BatchChecker(args.prelude, jobs=args.jobs, log_dir=args.log_dir)
+		prelude_time, prelude_failures, results = checker.check_all(args.sources)
+		print_batch_report(args.prelude, prelude_time, prelude_failures, results)
+		if args.json_report is not None:
+			with open(args.json_report, "w") as f:
+				json.dump({
+					"prelude": args.prelude,
+					"prelude_seconds": prelude_time,
+					"prelude_check_failures": prelude_failures,
+					"results": results,
+				}, f, indent=2)
+		if prelude_failures or any(not result["ok"] for result in results):
+			sys.exit(1)
 
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+"""
+native.py
+
+Compiles erased terms (see erasure.py) to Python source, and runs them as ordinary Python closures.
+Lambdas become Python lambdas, constructor values are tuples (tag, arg1, ..., argn), cases are conditional expressions on the tag, and fixpoints are curried functions that unfold once saturated.
+Every global definition is compiled once, and the compiled value is reused for as long as neither it nor anything it refers to has been redefined.
+
+As in erasure.py, Stuck is raised for anything that can't be compiled, run or read back, and the caller should fall back to the kernel.
+"""
+
+import itertools
+import easy
+import erasure
+from erasure import Stuck
+
+class BoxValue(object):
+	__slots__ = ()
+
+	def __call__(self, arg):
+		# Erased type families are applied to erased arguments.
+		return self
+
+	def __getitem__(self, index):
+		raise Stuck("Case on an erased term.")
+
+BOX = BoxValue()
+
+def make_constructor(tag, arity):
+	if arity == 0:
+		return (tag,)
+	def collect(args):
+		def take(arg):
+			new_args = args + (arg,)
+			if len(new_args) == arity:
+				return (tag,) + new_args
+			return collect(new_args)
+		return take
+	return collect(())
+
+def make_fix(make_body, arity, index):
+	"""make_fix(make_body, arity, index) -> curried function F, where make_body(F) is the uncurried body"""
+	def collect(args):
+		def take(arg):
+			new_args = args + (arg,)
+			if len(new_args) < arity:
+				return collect(new_args)
+			# Like the kernel, we only unfold on a constructor, so this can't diverge.
+			if not isinstance(new_args[index], tuple):
+				raise Stuck("Fix applied to a non-constructor.")
+			return body(*new_args)
+		return take
+	# Most fixpoints take one or two arguments, which we can curry without collecting tuples.
+	if arity == 1:
+		def F(a):
+			if not isinstance(a, tuple):
+				raise Stuck("Fix applied to a non-constructor.")
+			return body(a)
+	elif arity == 2:
+		def F(a):
+			def take(b):
+				if not isinstance((a, b)[index], tuple):
+					raise Stuck("Fix applied to a non-constructor.")
+				return body(a, b)
+			return take
+	else:
+		F = collect(())
+	body = make_body(F)
+	return F
+
+def stuck():
+	raise Stuck("Case without a matching arm.")
+
+def extend(scope, names, python_names):
+	scope = scope.copy()
+	scope.update(zip(names, python_names))
+	return scope
+
+# Constructor tags are interned, so that cases can test them with "is", whichever definition built the value.
+tags = {}
+
+def intern_tag(name, con_name):
+	return tags.setdefault((name, con_name), (name, con_name))
+
+class CompiledDefinition:
+	def __init__(self, definition, value, dependencies):
+		self.definition = definition
+		self.value = value
+		self.dependencies = dependencies
+
+# Compiled global definitions, by variable.
+compiled_definitions = {}
+
+class Compiler:
+	"""Compiler
+
+	Generates a Python expression for one piece of erased IR, along with the namespace it must be evaluated in.
+	"""
+	def __init__(self, ctx):
+		self.ctx = ctx
+		self.names = itertools.count()
+		self.namespace = {
+			"_box": BOX,
+			"_fix": make_fix,
+			"_stuck": stuck,
+		}
+		self.constants = {}
+		self.dependencies = {}
+		self.trees = {}
+
+	def fresh(self, prefix):
+		return "%s%i" % (prefix, next(self.names))
+
+	def constant(self, key, make):
+		if key not in self.constants:
+			name = self.constants[key] = self.fresh("_k")
+			self.namespace[name] = make()
+		return self.constants[key]
+
+	def tag(self, name, con_name):
+		return self.constant(("tag", name, con_name), lambda: intern_tag(name, con_name))
+
+	def constructor_tree(self, ir):
+		"""constructor_tree(ir) -> the value of ir if it's a tree of saturated constructors, otherwise None"""
+		if id(ir) not in self.trees:
+			fn, args = ir, []
+			while isinstance(fn, erasure.App):
+				args.append(fn.arg)
+				fn = fn.fn
+			value = None
+			if isinstance(fn, erasure.Con) and len(args) == fn.arity:
+				values = [self.constructor_tree(arg) for arg in reversed(args)]
+				if None not in values:
+					value = (self.namespace[self.tag(fn.name, fn.con_name)],) + tuple(values)
+			self.trees[id(ir)] = value
+		return self.trees[id(ir)]
+
+	def generate(self, ir, scope):
+		"""generate(ir, scope) -> Python source for ir, where scope maps IR variable names to Python names"""
+		if ir is erasure.BOX:
+			return "_box"
+		elif isinstance(ir, erasure.Var):
+			return scope[ir.name]
+		elif isinstance(ir, erasure.Global):
+			var = easy.Var(ir.name)
+			self.dependencies[var] = compile_definition(self.ctx, var)
+			return self.constant(("global", ir.name), lambda: self.dependencies[var].value)
+		elif isinstance(ir, erasure.Lam):
+			name = self.fresh("_v")
+			return "(lambda %s: %s)" % (name, self.generate(ir.body, extend(scope, [ir.var], [name])))
+		elif isinstance(ir, erasure.App):
+			# Literal data would otherwise nest as deeply in the generated source as it does in the term, which Python's parser can't handle.
+			value = self.constructor_tree(ir)
+			if value is not None:
+				return self.constant(("tree", id(ir)), lambda: value)
+			return "%s(%s)" % (self.generate(ir.fn, scope), self.generate(ir.arg, scope))
+		elif isinstance(ir, erasure.Let):
+			name = self.fresh("_v")
+			return "(lambda %s: %s)(%s)" % (name, self.generate(ir.body, extend(scope, [ir.var], [name])), self.generate(ir.value, scope))
+		elif isinstance(ir, erasure.Con):
+			tag = self.tag(ir.name, ir.con_name)
+			return self.constant(("constructor", ir.name, ir.con_name), lambda: make_constructor(self.namespace[tag], ir.arity))
+		elif isinstance(ir, erasure.Fix):
+			recursive_name = self.fresh("_f")
+			param_names = [self.fresh("_v") for _ in ir.params]
+			body_scope = extend(scope, [ir.recursive_name] + ir.params, [recursive_name] + param_names)
+			return "_fix(lambda %s: lambda %s: %s, %i, %i)" % (
+				recursive_name,
+				", ".join(param_names),
+				self.generate(ir.body, body_scope),
+				len(ir.params),
+				ir.structural_index,
+			)
+		elif isinstance(ir, erasure.Case):
+			scrutinee = self.fresh("_s")
+			code = "_stuck()"
+			for con_name, (names, body) in ir.arms.iteritems():
+				tag = self.tag(ir.name, con_name)
+				if names:
+					param_names = [self.fresh("_v") for _ in names]
+					arm = "(lambda %s: %s)(*%s[1:])" % (", ".join(param_names), self.generate(body, extend(scope, names, param_names)), scrutinee)
+				else:
+					arm = self.generate(body, scope)
+				code = "%s if %s[0] is %s else %s" % (arm, scrutinee, tag, code)
+			return "(lambda %s: %s)(%s)" % (scrutinee, code, self.generate(ir.scrutinee, scope))
+		raise Stuck("Can't compile: %r" % (ir,))
+
+	def run(self, ir):
+		source = self.generate(ir, {})
+		try:
+			code = compile(source, "<native>", "eval")
+		except (SyntaxError, MemoryError, RuntimeError):
+			raise Stuck("Generated code is too deeply nested.")
+		return eval(code, self.namespace)
+
+def is_current(ctx, var, seen=None):
+	"""is_current(ctx, var) -> True if var's compiled definition is still the one in ctx, as are all its dependencies'"""
+	seen = set() if seen is None else seen
+	if var in seen:
+		return True
+	seen.add(var)
+	compiled = compiled_definitions.get(var)
+	if compiled is None or not ctx.unfoldable(var) or ctx.lookup_def(var) is not compiled.definition:
+		return False
+	return all(is_current(ctx, dependency, seen) for dependency in compiled.dependencies)
+
+def compile_definition(ctx, var):
+	"""compile_definition(ctx, var) -> the CompiledDefinition of var, compiling it if need be"""
+	if var in compiled_definitions and compiled_definitions[var] is None:
+		raise Stuck("Definition refers to itself: %r" % (var,))
+	if is_current(ctx, var):
+		return compiled_definitions[var]
+	definition = ctx.lookup_def(var)
+	# Mark var as being compiled, so a definition that (through a redefinition) refers to itself gets stuck rather than looping.
+	compiled_definitions[var] = None
+	try:
+		ir = erasure.Eraser(ctx).erase(ctx, definition, frozenset())
+		compiler = Compiler(ctx)
+		value = compiler.run(ir)
+	except:
+		compiled_definitions.pop(var, None)
+		raise
+	compiled = compiled_definitions[var] = CompiledDefinition(definition, value, compiler.dependencies)
+	return compiled
+
+def unpack_constructor_value(value):
+	if not isinstance(value, tuple):
+		raise Stuck("Only constructor values can be read back.")
+	(name, con_name), args = value[0], value[1:]
+	# Compiled code uses its own BOX, but read_back looks for erasure's.
+	return name, con_name, tuple(erasure.BOX if arg is BOX else arg for arg in args)
+
+def evaluate(ctx, term):
+	"""evaluate(ctx, term) -> the value of term, as a kernel term
+
+	Raises Stuck if term can't be compiled and run, or if its value isn't a constructor tree.
+	"""
+	ir = erasure.Eraser(ctx).erase(ctx, term, frozenset())
+	return erasure.read_back(ctx, Compiler(ctx).run(ir), easy.synthesize_type(ctx, term), unpack_constructor_value)
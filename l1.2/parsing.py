@@ -21,7 +21,7 @@ def unpack_typed_params(ctx, typed_params):
 	for child in typed_params.children:
 		if child.data == "untyped_param":
 			var_name, = child.children
-			results.append((easy.Var(str(var_name)), easy.Hole()))
+			results.append((easy.Var(str(var_name)), ctx.metas.fresh_type()))
 		elif child.data == "param_group":
 			ty = unpack_term_ast(ctx, child.children[-1])
 			for var_name in child.children[:-1]:
@@ -50,7 +50,7 @@ def wrap_with_typed_params(ctx, typed_params, term, mode):
 
 def unpack_optional_type_annotation(ctx, annot):
 	if not annot.children:
-		return easy.Hole()
+		return ctx.metas.fresh_type()
 	annot_ty_ast, = annot.children
 	return unpack_term_ast(ctx, annot_ty_ast)
 
@@ -80,6 +80,14 @@ def unpack_term_ast(ctx, ast):
 	if ast.data == "annotation":
 		x, ty = [unpack_term_ast(ctx, child) for child in ast.children]
 		return easy.Annotation(x, ty)
+	if ast.data == "let":
+		name, optional_type_annotation, value, body = ast.children
+		return easy.Let(
+			easy.Var(str(name)),
+			unpack_optional_type_annotation(ctx, optional_type_annotation),
+			unpack_term_ast(ctx, value),
+			unpack_term_ast(ctx, body),
+		)
 	if ast.data == "constructor":
 		# XXX: Check name presense.
 		ind_name, con_name = map(str, ast.children)
@@ -87,10 +95,12 @@ def unpack_term_ast(ctx, ast):
 	if ast.data == "match":
 		ast_matchand, ast_extensions, ast_arms = ast.children
 		match_term = unpack_term_ast(ctx, ast_matchand)
+		# The as and in clauses are binders, so when they're missing they're left as anonymous Holes.
+		# A missing return clause is a metavariable to be solved while checking the arms.
 		extensions = {
 			"as": easy.Hole(),
 			"in": easy.Hole(),
-			"return": easy.Hole(),
+			"return": ctx.metas.fresh_type(),
 		}
 		# Process extensions.
 		for child in ast_extensions.children:
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+printing.py
+
+An iterative printer for kernel terms that streams its output to a file object.
+Without options it produces exactly the same text as the terms' __repr__s, but it never recurses, never builds the whole string, and decides arrows vs. foralls using free variable sets computed once per node.
+
+Options:
+	max_depth: subterms nested deeper than this are printed as "…".
+	max_width: output is cut off with "…" after this many characters.
+	sharing: subterms that occur more than once (by identity) are printed once each, as let-bindings in front of the term.
+	  Printing then costs time linear in the size of the term's DAG, rather than its tree.
+"""
+
+import sys, StringIO
+import easy
+
+ELLIPSIS = "\xe2\x80\xa6"
+
+class Truncated(Exception):
+	pass
+
+class BudgetedWriter:
+	def __init__(self, out, max_width):
+		self.out = out
+		self.remaining = max_width
+
+	def write(self, s):
+		if self.remaining is not None:
+			# The budget is in characters, so count and cut decoded text, never splitting a UTF-8 sequence.
+			text = s.decode("utf-8") if isinstance(s, str) else s
+			if len(text) > self.remaining:
+				self.out.write(text[:self.remaining].encode("utf-8"))
+				self.remaining = 0
+				raise Truncated()
+			self.remaining -= len(text)
+		self.out.write(s)
+
+def children(t):
+	"""children(t) -> [(child, names bound in child)]"""
+	if isinstance(t, easy.Annotation):
+		return [(t.term, ()), (t.ty, ())]
+	elif isinstance(t, easy.DependentProduct):
+		return [(t.var_ty, ()), (t.result_ty, (t.var,))]
+	elif isinstance(t, easy.Abstraction):
+		return [(t.var_ty, ()), (t.result, (t.var,))]
+	elif isinstance(t, easy.Application):
+		return [(t.fn, ()), (t.arg, ())]
+	elif isinstance(t, easy.Let):
+		return [(t.ty, ()), (t.value, ()), (t.body, (t.var,))]
+	elif isinstance(t, easy.Fix):
+		params = [easy.Var(name) for name in t.params.names]
+		result = [(ty, tuple(params[:i])) for i, ty in enumerate(t.params.types)]
+		result.append((t.ty, tuple(params)))
+		result.append((t.body, tuple(params) + (t.recursive_var,)))
+		return result
+	elif isinstance(t, easy.Match):
+		_, in_args = easy.extract_app_spine(t.in_term)
+		return_binders = tuple(in_args) + ((t.as_term,) if isinstance(t.as_term, easy.Var) else ())
+		result = [(t.matchand, ()), (t.as_term, ()), (t.in_term, ()), (t.return_term, return_binders)]
+		for arm in t.arms:
+			result.append((arm.pattern, ()))
+			result.append((arm.result, tuple(arm.pattern_args)))
+		return result
+	elif isinstance(t, easy.Axiom):
+		return [(t.ty, ())]
+	return []
+
+class TermPrinter:
+	def __init__(self, out=sys.stdout, max_depth=None, max_width=None, sharing=False):
+		self.out = BudgetedWriter(out, max_width)
+		self.max_depth = max_depth
+		self.sharing = sharing
+
+	def analyze(self, root):
+		"""analyze(root)
+
+		Walk the DAG under root once, in post-order, computing for each node (by identity):
+			self.free[id]: its free variables.
+			self.uses[id]: how many times it's referenced.
+		Also collects self.binders, every variable bound anywhere under root.
+		"""
+		self.free = {}
+		self.uses = {id(root): 1}
+		self.binders = set()
+		self.order = []
+		expanded = set()
+		stack = [(root, False)]
+		while stack:
+			t, finish = stack.pop()
+			if finish:
+				free = set()
+				if isinstance(t, easy.Var):
+					free.add(t)
+				for child, bound in children(t):
+					if bound:
+						free |= self.free[id(child)] - set(bound)
+					else:
+						free |= self.free[id(child)]
+				# Like Axiom.free_vars, we don't count the variables in an axiom's type.
+				if isinstance(t, easy.Axiom):
+					free = set()
+				self.free[id(t)] = frozenset(free)
+				self.order.append(t)
+				continue
+			if id(t) in expanded:
+				continue
+			expanded.add(id(t))
+			stack.append((t, True))
+			for child, bound in children(t):
+				self.binders.update(bound)
+				self.uses[id(child)] = self.uses.get(id(child), 0) + 1
+				# A child may already be on the stack from another parent, but it will be expanded only once, and always before we finish.
+				if id(child) not in expanded:
+					stack.append((child, False))
+
+	def shareable(self, t):
+		# Only compound subterms are worth naming, and only those that can't be captured by a binder may be hoisted out to a top-level let.
+		return (
+			self.uses[id(t)] > 1
+			and isinstance(t, (easy.Annotation, easy.DependentProduct, easy.Abstraction, easy.Application, easy.Let, easy.Fix, easy.Match))
+			and not (self.free[id(t)] & self.binders)
+		)
+
+	def print_term(self, root):
+		self.analyze(root)
+		self.names = {}
+		try:
+			if self.sharing:
+				# self.order is a post-order, so every let only mentions names bound by earlier lets.
+				for t in self.order:
+					if t is not root and self.shareable(t):
+						name = "$%i" % (len(self.names) + 1,)
+						self.out.write("let %s := " % (name,))
+						self.emit(t)
+						self.out.write(" in\n")
+						self.names[id(t)] = name
+			self.emit(root)
+		except Truncated:
+			self.out.out.write(ELLIPSIS)
+
+	def emit(self, root):
+		# The stack holds strings to write verbatim, and (term, depth) pairs to expand.
+		stack = [(root, 0)]
+		while stack:
+			item = stack.pop()
+			if isinstance(item, str):
+				self.out.write(item)
+				continue
+			t, depth = item
+			if id(t) in self.names:
+				self.out.write(self.names[id(t)])
+				continue
+			if self.max_depth is not None and depth > self.max_depth:
+				self.out.write(ELLIPSIS)
+				continue
+			parts = self.layout(t)
+			if parts is None:
+				self.out.write(repr(t))
+				continue
+			for part in reversed(parts):
+				stack.append(part if isinstance(part, str) else (part, depth + 1))
+
+	def layout(self, t):
+		"""layout(t) -> list of strings and subterms matching t's __repr__, or None if t is a leaf"""
+		if isinstance(t, easy.Annotation):
+			return ["(", t.term, " :: ", t.ty, ")"]
+		elif isinstance(t, easy.DependentProduct):
+			if t.var not in self.free[id(t.result_ty)]:
+				return ["(", t.var_ty, " \xe2\x86\x92 ", t.result_ty, ")"]
+			return ["(\xe2\x88\x80 %s : " % (t.var,), t.var_ty, " . ", t.result_ty, ")"]
+		elif isinstance(t, easy.Abstraction):
+			return ["(\xce\xbb %s : " % (t.var,), t.var_ty, " . ", t.result, ")"]
+		elif isinstance(t, easy.Application):
+			return ["(", t.fn, " ", t.arg, ")"]
+		elif isinstance(t, easy.Let):
+			return ["(let %s : " % (t.var,), t.ty, " := ", t.value, " in ", t.body, ")"]
+		elif isinstance(t, easy.Fix):
+			parts = ["fix %s " % (t.recursive_var,)]
+			for i, (name, ty) in enumerate(zip(t.params.names, t.params.types)):
+				parts += [" " if i else "", "(%s : " % (name,), ty, ")"]
+			return parts + [" : ", t.ty, " := ", t.body]
+		elif isinstance(t, easy.Match):
+			parts = ["match ", t.matchand, " as ", t.as_term, " in ", t.in_term, " return ", t.return_term, " with"]
+			for arm in t.arms:
+				parts += [" | ", arm.pattern, " => ", arm.result]
+			return parts + [" end"]
+		elif isinstance(t, easy.Axiom):
+			return ["<axiom : ", t.ty, ">"]
+		return None
+
+def print_term(term, out=sys.stdout, **kwargs):
+	"""print_term(term, out=sys.stdout, max_depth=None, max_width=None, sharing=False)"""
+	TermPrinter(out, **kwargs).print_term(term)
+
+def format_term(term, **kwargs):
+	out = StringIO.StringIO()
+	print_term(term, out, **kwargs)
+	return out.getvalue()
+
+if __name__ == "__main__":
+	nat_S = easy.ConstructorRef("nat", "S")
+	shared = easy.Application(nat_S, easy.Application(nat_S, easy.ConstructorRef("nat", "O")))
+	term = easy.Application(easy.Application(easy.Var("add"), shared), shared)
+	for kwargs in [{}, {"sharing": True}, {"max_depth": 2}, {"max_width": 20}]:
+		print kwargs
+		print_term(term, **kwargs)
+		print
+	product = easy.DependentProduct(easy.Var("x"), easy.Var("nat"), easy.Application(easy.Var("P"), easy.Var("x")))
+	assert format_term(product) == repr(product)
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+import os, sys, unittest, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import easy
+import main
+
+def interpret_source(source):
+	with tempfile.NamedTemporaryFile(suffix=".ez") as f:
+		f.write(source)
+		f.flush()
+		return main.interpret(f.name)
+
+class Tests(unittest.TestCase):
+	def test_proof_cache_hits(self):
+		ctx = interpret_source("Axiom P : Prop.\n")
+		P, q, x = easy.Var("P"), easy.Var("q"), easy.Var("x")
+		ctx = ctx.extend_ty(q, P)
+		# Two different proofs of P, with the same free variable.
+		t1 = q
+		t2 = easy.Application(easy.Abstraction(x, P, x), q)
+		cache = ctx.proof_cache
+		self.assertEqual(easy.proof_type(ctx, t1), P)
+		self.assertEqual(easy.proof_type(ctx, t2), P)
+		self.assertEqual((cache.hits, cache.misses), (0, 2))
+		# Each has its own entry, so both are now hits, even under alpha-renaming.
+		self.assertEqual(easy.proof_type(ctx, t1), P)
+		self.assertEqual(easy.proof_type(ctx, easy.Application(easy.Abstraction(easy.Var("y"), P, easy.Var("y")), q)), P)
+		self.assertEqual((cache.hits, cache.misses), (2, 2))
+		# A non-proof is remembered too.
+		self.assertEqual(easy.proof_type(ctx, P), None)
+		self.assertEqual(easy.proof_type(ctx, P), None)
+		self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+	def test_unify_alpha_equivalent_fixpoints(self):
+		ctx = interpret_source("""
+			Inductive nat : Type0 := | O : nat | S : nat -> nat.
+			Definition f1 := fun (a : nat) => fix F (x : nat) : nat := a.
+			Definition f2 := fun (b : nat) => fix G (y : nat) : nat := b.
+			Definition f3 := fun (a : nat) => fun (b : nat) => fix F (x : nat) : nat := a.
+			Definition f4 := fun (b : nat) => fun (a : nat) => fix F (x : nat) : nat := a.
+		""")
+		f1, f2, f3, f4 = [ctx.definitions[easy.Var(name)] for name in ("f1", "f2", "f3", "f4")]
+		self.assertTrue(ctx.metas.unify(ctx, f1, f2))
+		# f3 returns its first argument and f4 its second, despite the matching names.
+		self.assertFalse(ctx.metas.unify(ctx, f3, f4))
+
+	def test_compare_stuck_fixpoint_applications(self):
+		ctx = interpret_source("""
+			Inductive nat : Type0 := | O : nat | S : nat -> nat.
+			Definition add :=
+				fix F (x : nat) (y : nat) : nat :=
+					match x ~ return nat with
+					| nat::O => y
+					| nat::S x' => F x' (nat::S y)
+					end.
+		""")
+		nat, O = easy.InductiveRef("nat"), easy.ConstructorRef("nat", "O")
+		add, y, z = easy.Var("add"), easy.Var("y"), easy.Var("z")
+		ctx = ctx.extend_ty(y, nat)
+		# Both sides normalize to the unapplied fixpoint stuck on y, which must be compared up to renaming.
+		t1 = easy.form_app_spine(add, [y, O])
+		t2 = easy.Application(easy.Abstraction(z, nat, easy.form_app_spine(add, [z, O])), y)
+		self.assertTrue(easy.compare_terms(ctx, t1, t2))
+
+	def test_subst_avoids_capture_through_solved_metas(self):
+		metas = easy.MetaContext()
+		x, y, h = easy.Var("x"), easy.Var("y"), easy.Var("h")
+		m = metas.fresh_type()
+		metas.assign(m.identifier, x)
+		# fun (x : Type0) => h, with h := fun (y : ?m) => y and ?m := x, the outer x.
+		result = easy.Abstraction(x, easy.SortType(0), h).subst(h, easy.Abstraction(y, m, y))
+		result = metas.zonk(result)
+		self.assertNotEqual(result.var, x)
+		self.assertEqual(result.result.var_ty, x)
+
+if __name__ == "__main__":
+	unittest.main()
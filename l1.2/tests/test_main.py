@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import os, sys, json, shutil, unittest, tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+
+class Tests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def write_source(self, name, source):
+		path = os.path.join(self.directory, name)
+		with open(path, "w") as f:
+			f.write(source)
+		return path
+
+	def test_prelude_check_failures(self):
+		prelude = self.write_source("prelude.ez", "Inductive nat : Type0 := | O : nat | S : nat -> nat.\nCheck nat::O : Type0.\n")
+		source = self.write_source("source.ez", "Check nat::S nat::O : nat.\n")
+		prelude_time, prelude_failures, results = main.BatchChecker(prelude).check_all([source])
+		self.assertEqual(len(prelude_failures), 1)
+		# The prelude's failure isn't blamed on the file.
+		self.assertEqual([(result["ok"], result["check_failures"]) for result in results], [(True, [])])
+
+	def test_large_results(self):
+		# A result much bigger than a pipe's buffer must still arrive whole.
+		name = "x" * 200000
+		source = "Inductive nat : Type0 := | O : nat | S : nat -> nat.\nCheck nat::O : %s.\n" % (name,)
+		paths = [self.write_source("source%i.ez" % (i,), source) for i in range(3)]
+		prelude_time, prelude_failures, results = main.BatchChecker(jobs=2).check_all(paths)
+		self.assertEqual([result["path"] for result in results], paths)
+		for result in results:
+			self.assertFalse(result["ok"])
+			self.assertEqual(result["check_failures"], ["Failure to match: nat != %s" % (name,)])
+
+	def test_eval_too_deep(self):
+		source = self.write_source("source.ez", """
+			Inductive nat : Type0 := | O : nat | S : nat -> nat.
+			Definition add := fix F (x : nat) (y : nat) : nat := match x with | nat::O => y | nat::S x' => F x' (nat::S y) end.
+			Definition mul := fix G (x : nat) (y : nat) : nat := match x with | nat::O => nat::O | nat::S x' => add y (G x' y) end.
+			Definition seven := nat::S (nat::S (nat::S (nat::S (nat::S (nat::S (nat::S nat::O)))))).
+			Eval mul (mul seven seven) (mul seven seven).
+			Eval nat::S nat::O.
+		""")
+		log_path = os.path.join(self.directory, "source.log")
+		main.BatchChecker().run_quietly(log_path, lambda: main.interpret(source))
+		with open(log_path) as f:
+			evals = [line for line in f.read().split("\n") if line.startswith("Eval")]
+		# Running out of stack is reported, and doesn't stop the later Evals.
+		self.assertEqual(len(evals), 2)
+		self.assertTrue(evals[0].startswith("Eval failure: maximum recursion depth exceeded"))
+		self.assertEqual(evals[1], "Eval: (nat::S nat::O)")
+
+if __name__ == "__main__":
+	unittest.main()
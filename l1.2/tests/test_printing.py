@@ -0,0 +1,23 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import os, sys, unittest, StringIO
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import easy
+import printing
+
+class Tests(unittest.TestCase):
+	def test_max_width_counts_characters(self):
+		# Prints as "(λ x : 𝕋₀ . x)", where λ, 𝕋 and ₀ all take several bytes.
+		term = easy.Abstraction(easy.Var("x"), easy.SortType(0), easy.Var("x"))
+		out = StringIO.StringIO()
+		printing.print_term(term, out)
+		full = out.getvalue().decode("utf-8")
+		for width in range(len(full) + 1):
+			out = StringIO.StringIO()
+			printing.print_term(term, out, max_width=width)
+			printed = out.getvalue().decode("utf-8")
+			self.assertTrue(printed.startswith(full[:width]))
+
+if __name__ == "__main__":
+	unittest.main()